@@ -0,0 +1,287 @@
+"""
+Single pass binning engine for the exposure grids. Computes the cell
+index of every measurement once, sorts by (network provider, cell) and
+takes all per provider per cell medians with segment reductions, instead
+of one scipy.stats.binned_statistic_2d call per provider.
+
+The grid and the bin assignment follow binned_statistic_2d exactly, so
+the results match the per provider binning value for value.
+
+SparseGrid keeps only the cells that hold measurements, for grids where
+a dense array over the bounding box would not fit in memory.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def grid_edges(xmin, xmax, ymin, ymax, cell_size):
+    """
+    Define the raster grid around the data bounds.
+
+    Args:
+        xmin, xmax, ymin, ymax (float): Data bounds in CRS units.
+        cell_size: int in georeferences units based on CRS (meters in the
+        case of EPSG:3035)
+
+    Returns:
+        tuple: (x_edges, y_edges) as numpy arrays. The grid origin is
+        aligned to a multiple of cell_size.
+    """
+    # Calculate the number of cells in x and y directions
+    ncols = int(np.ceil((xmax - xmin) / cell_size))
+    nrows = int(np.ceil((ymax - ymin) / cell_size))
+
+    # Adjust bounds to ensure they are multiples of cell_size
+    xmin_adj = np.floor(xmin / cell_size) * cell_size
+    xmax_adj = xmin_adj + ncols * cell_size
+    ymin_adj = np.floor(ymin / cell_size) * cell_size
+    ymax_adj = ymin_adj + nrows * cell_size
+
+    x_edges = np.linspace(xmin_adj, xmax_adj, ncols + 1)
+    y_edges = np.linspace(ymin_adj, ymax_adj, nrows + 1)
+    return x_edges, y_edges
+
+def bin_indices(values, edges):
+    """
+    Assign values to bins the way scipy's binned statistics do: bins are
+    closed on the left, except the last bin which also holds values on
+    its right edge.
+
+    Args:
+        values (numpy.ndarray): Coordinates along one axis.
+        edges (numpy.ndarray): Increasing bin edges along that axis.
+
+    Returns:
+        numpy.ndarray: 0-based int64 bin index per value, -1 for values
+        outside the edges.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    nbins = len(edges) - 1
+    if nbins < 1:
+        return np.full(values.shape, -1, dtype=np.int64)
+
+    indices = np.digitize(values, edges).astype(np.int64)
+    decimal = int(-np.log10(np.diff(edges).min())) + 6
+    on_edge = (values >= edges[-1]) & (np.around(values, decimal) == np.around(edges[-1], decimal))
+    indices[on_edge] -= 1
+
+    indices -= 1
+    indices[(indices < 0) | (indices >= nbins)] = -1
+    return indices
+
+def cell_medians(group_ids, cell_ids, values):
+    """
+    Median of the values per (group, cell) with one sort.
+
+    Args:
+        group_ids (numpy.ndarray): Integer group (network provider) code
+        per value.
+        cell_ids (numpy.ndarray): Integer cell id per value.
+        values (numpy.ndarray): Values to take the median of.
+
+    Returns:
+        tuple: (group_ids, cell_ids, medians) with one entry per
+        (group, cell), sorted by group and then cell. For an even number
+        of values the median is the mean of the two middle values, as in
+        binned_statistic_2d.
+    """
+    if len(values) == 0:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                np.empty(0, dtype=np.float64))
+
+    order = np.lexsort((values, cell_ids, group_ids))
+    group_ids = group_ids[order]
+    cell_ids = cell_ids[order]
+    values = values[order]
+
+    new_segment = (group_ids[1:] != group_ids[:-1]) | (cell_ids[1:] != cell_ids[:-1])
+    starts = np.concatenate(([0], np.flatnonzero(new_segment) + 1))
+    counts = np.diff(np.append(starts, len(values)))
+
+    mid = starts + (counts - 1) / 2
+    mid_a = values[np.floor(mid).astype(np.int64)]
+    mid_b = values[np.ceil(mid).astype(np.int64)]
+    medians = (mid_a + mid_b) / 2
+    return group_ids[starts], cell_ids[starts], medians
+
+def sum_group_medians(group_ids, cell_positions, medians, n_cells):
+    """
+    Sum the per group medians per cell and count the groups with a
+    non-zero median, adding the groups in order of their code.
+
+    Args:
+        group_ids, medians: Output of cell_medians.
+        cell_positions (numpy.ndarray): Position of every entry in the
+        output arrays, e.g. the cell ids from cell_medians.
+        n_cells (int): Length of the output arrays.
+
+    Returns:
+        tuple: (sum_flat, count_flat) float64 arrays of length n_cells.
+    """
+    sum_flat = np.zeros(n_cells)
+    count_flat = np.zeros(n_cells)
+
+    #cells are unique within a group, so each group is one fancy-index add
+    group_starts = np.flatnonzero(np.diff(group_ids, prepend=-1))
+    group_ends = np.append(group_starts[1:], len(group_ids))
+    for start, end in zip(group_starts, group_ends):
+        cells = cell_positions[start:end]
+        sum_flat[cells] += medians[start:end]
+        count_flat[cells] += medians[start:end] != 0
+    return sum_flat, count_flat
+
+def cell_indices(df, x_edges, y_edges):
+    """
+    Provider codes, bin indices and LTE_mW_total of the measurements
+    inside the grid. Providers are coded in order of first appearance,
+    like split_dataframes.
+
+    Returns:
+        tuple: (provider_ids, xi, yi, values) as int64 and float64 arrays.
+    """
+    provider_ids, _ = pd.factorize(df['DIRECT_connection_mcc_mnc'], sort=False)
+    xi = bin_indices(df['x'].to_numpy(), x_edges)
+    yi = bin_indices(df['y'].to_numpy(), y_edges)
+
+    inside = (xi >= 0) & (yi >= 0) & (provider_ids >= 0)
+    values = df['LTE_mW_total'].to_numpy(dtype=np.float64)[inside]
+    return provider_ids[inside].astype(np.int64), xi[inside], yi[inside], values
+
+def grouped_cell_sums(group_ids, cell_ids, values):
+    """
+    Sum of the per group median values, and the number of groups, per
+    cell.
+
+    Returns:
+        tuple: (cell_ids, sums, counts) for the sorted unique cell ids.
+    """
+    group_ids, cell_ids, medians = cell_medians(group_ids, cell_ids, values)
+    unique_cells, positions = np.unique(cell_ids, return_inverse=True)
+    sums, counts = sum_group_medians(group_ids, positions, medians, len(unique_cells))
+    return unique_cells, sums, counts
+
+def provider_cell_sums(df, x_edges, y_edges):
+    """
+    Sum of the per provider median LTE_mW_total, and the number of
+    providers, for every cell that holds measurements.
+
+    Args:
+        df (DataFrame): Measurements with 'x', 'y',
+        'DIRECT_connection_mcc_mnc' and 'LTE_mW_total' columns.
+        x_edges, y_edges (numpy.ndarray): Grid edges from grid_edges.
+
+    Returns:
+        tuple: (cell_ids, sums, counts), where cell_ids are sorted flat
+        indices into an (ncols, nrows) array: x_index * nrows + y_index.
+    """
+    nrows = len(y_edges) - 1
+    provider_ids, xi, yi, values = cell_indices(df, x_edges, y_edges)
+    return grouped_cell_sums(provider_ids, xi * nrows + yi, values)
+
+def binned_provider_sums(df, x_edges, y_edges):
+    """
+    Sum of the per provider median LTE_mW_total per cell, and the number
+    of providers per cell, in one pass over the data.
+
+    Args:
+        df (DataFrame): Measurements with 'x', 'y',
+        'DIRECT_connection_mcc_mnc' and 'LTE_mW_total' columns.
+        x_edges, y_edges (numpy.ndarray): Grid edges from grid_edges.
+
+    Returns:
+        tuple: (sum_array, count_array) of shape (ncols, nrows), equal to
+        summing binned_statistic_2d(statistic='median') over the
+        providers in order of first appearance.
+    """
+    ncols = len(x_edges) - 1
+    nrows = len(y_edges) - 1
+
+    cell_ids, sums, counts = provider_cell_sums(df, x_edges, y_edges)
+    sum_flat = np.zeros(ncols * nrows)
+    count_flat = np.zeros(ncols * nrows)
+    sum_flat[cell_ids] = sums
+    count_flat[cell_ids] = counts
+    return sum_flat.reshape(ncols, nrows), count_flat.reshape(ncols, nrows)
+
+class SparseGrid:
+    """
+    Raster grid that only stores the cells with data, as (row, col)
+    coordinates in raster orientation (row 0 is the northern edge) with
+    one value per cell. Cells that are not stored are nodata.
+
+    Elementwise steps such as log10 and map_calibration are applied to
+    the values with with_values; the grid is only rasterized, one tile at
+    a time, when it is written.
+    """
+
+    def __init__(self, height, width, rows, cols, values):
+        self.height = height
+        self.width = width
+        self.rows = rows
+        self.cols = cols
+        self.values = values
+
+    @classmethod
+    def from_cell_ids(cls, cell_ids, values, ncols, nrows):
+        """
+        Build from flat (ncols, nrows) cell ids as returned by
+        provider_cell_sums, matching np.rot90(array, k=1) of the dense
+        (ncols, nrows) array.
+        """
+        return cls(nrows, ncols, nrows - 1 - cell_ids % nrows, cell_ids // nrows, values)
+
+    @property
+    def shape(self):
+        return (self.height, self.width)
+
+    def with_values(self, values):
+        """Return a grid with the same cells and new values."""
+        return SparseGrid(self.height, self.width, self.rows, self.cols, values)
+
+    def to_dense(self, row_off=0, col_off=0, height=None, width=None,
+                 fill_value=np.nan, dtype=np.float64):
+        """
+        Rasterize a window of the grid.
+
+        Args:
+            row_off, col_off (int): Upper left corner of the window.
+            height, width (int): Window size, the full grid by default.
+            fill_value: Value of cells without data.
+            dtype: dtype of the returned array.
+
+        Returns:
+            numpy.ndarray: (height, width) array.
+        """
+        height = self.height - row_off if height is None else height
+        width = self.width - col_off if width is None else width
+        dense = np.full((height, width), fill_value, dtype=dtype)
+        in_window = ((self.rows >= row_off) & (self.rows < row_off + height)
+                     & (self.cols >= col_off) & (self.cols < col_off + width))
+        dense[self.rows[in_window] - row_off, self.cols[in_window] - col_off] = self.values[in_window]
+        return dense
+
+    def tiles(self, tile_size, fill_value=np.nan, dtype=np.float64):
+        """
+        Rasterize the grid tile by tile, skipping tiles without data.
+
+        Yields:
+            tuple: (row_off, col_off, array) per tile with data. Tiles at
+            the right and bottom edge are clipped to the grid.
+        """
+        tiles_per_row = -(-self.width // tile_size)
+        tile_ids = (self.rows // tile_size) * tiles_per_row + self.cols // tile_size
+        order = np.argsort(tile_ids, kind='stable')
+        tile_ids = tile_ids[order]
+        starts = np.flatnonzero(np.diff(tile_ids, prepend=-1))
+        ends = np.append(starts[1:], len(tile_ids))
+
+        for start, end in zip(starts, ends):
+            row_off = int(tile_ids[start] // tiles_per_row) * tile_size
+            col_off = int(tile_ids[start] % tiles_per_row) * tile_size
+            height = min(tile_size, self.height - row_off)
+            width = min(tile_size, self.width - col_off)
+            cells = order[start:end]
+            tile = np.full((height, width), fill_value, dtype=dtype)
+            tile[self.rows[cells] - row_off, self.cols[cells] - col_off] = self.values[cells]
+            yield row_off, col_off, tile
@@ -0,0 +1,114 @@
+"""
+Local cache of the country borders of spatial_help.european_borders_simple,
+transformed to EPSG:3035 and simplified, with their bounding boxes and
+areas per nuts code. The cache is a GeoPackage next to the frame cache;
+a fingerprint of the border geometries in the database is stored with
+it, and the cache is rebuilt when the borders change.
+
+Used to lay out the grid of a country over its bounding box
+(country_bounds, see main.process_country with country_grid): the grid
+no longer depends on the measurements of the run, and far away outliers
+fall outside it and are dropped while binning. The areas give the
+scheduler size estimates for countries without measurement counts from
+an earlier run. The main process checks the cache against the database
+once per run, the workers read it without the check.
+"""
+
+import json
+import os
+
+import geopandas as gpd
+
+import db_connection
+import frame_cache
+import sql_queries
+
+BORDERS_FOLDER = os.path.join(frame_cache.CACHE_FOLDER, 'borders')
+#simplification of the cached polygons, in meters
+SIMPLIFY_TOLERANCE = 100
+
+_loaded = {}
+
+
+def _cache_paths(cache_folder, tolerance):
+    name = f'borders_3035_{tolerance}m'
+    return os.path.join(cache_folder, f'{name}.gpkg'), os.path.join(cache_folder, f'{name}.json')
+
+def _fingerprint():
+    with db_connection.get_engine().connect() as conn:
+        return conn.exec_driver_sql(sql_queries.borders_fingerprint()).scalar()
+
+def _fetch_borders(tolerance):
+    borders = gpd.GeoDataFrame.from_postgis(sql_queries.borders_3035(tolerance), db_connection.get_engine(),
+                                            geom_col='geom', crs='EPSG:3035')
+    #one row per nuts code
+    borders = borders.dissolve(by='nuts', as_index=False)
+    xmin, ymin, xmax, ymax = borders.geometry.bounds.to_numpy().T
+    borders['xmin'], borders['ymin'], borders['xmax'], borders['ymax'] = xmin, ymin, xmax, ymax
+    borders['area_km2'] = borders.geometry.area / 1e6
+    return borders
+
+def load_borders(cache_folder=BORDERS_FOLDER, tolerance=SIMPLIFY_TOLERANCE, check=True, refresh=False):
+    """
+    Cached country borders, fetched again when the borders in the
+    database changed. The database is checked once per process.
+
+    Args:
+        cache_folder (str): Folder of the cache files.
+        tolerance: Simplification tolerance in meters.
+        check (bool): Compare the cache with the database. Without it the
+        cache is used as is, if it exists.
+        refresh (bool): Rebuild the cache.
+
+    Returns:
+        geopandas.GeoDataFrame: nuts, geom (EPSG:3035), xmin, ymin, xmax,
+        ymax and area_km2 per country, indexed by nuts.
+    """
+    memo_key = (cache_folder, tolerance)
+    if memo_key in _loaded and not refresh:
+        return _loaded[memo_key]
+
+    gpkg_path, meta_path = _cache_paths(cache_folder, tolerance)
+    cached_fingerprint = None
+    if os.path.exists(gpkg_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            cached_fingerprint = json.load(f).get('fingerprint')
+
+    fingerprint = None
+    if check or refresh or cached_fingerprint is None:
+        try:
+            fingerprint = _fingerprint()
+        except Exception as e:
+            if cached_fingerprint is None:
+                raise
+            print(f'Could not check the country borders ({e}), using the cached borders')
+
+    if refresh or cached_fingerprint is None or (fingerprint is not None and fingerprint != cached_fingerprint):
+        print('Caching the country borders...')
+        borders = _fetch_borders(tolerance)
+        os.makedirs(cache_folder, exist_ok=True)
+        borders.to_file(gpkg_path, driver='GPKG')
+        with open(meta_path, 'w') as f:
+            json.dump({'fingerprint': fingerprint, 'tolerance': tolerance}, f)
+    else:
+        borders = gpd.read_file(gpkg_path).rename_geometry('geom')
+
+    borders = borders.set_index('nuts', drop=False)
+    _loaded[memo_key] = borders
+    return borders
+
+def country_bounds(country_code, **kwargs):
+    """
+    Bounding box of a country in EPSG:3035, see load_borders for kwargs.
+
+    Returns:
+        tuple: (xmin, ymin, xmax, ymax), or None for an unknown nuts code.
+    """
+    borders = load_borders(**kwargs)
+    if country_code not in borders.index:
+        return None
+    return tuple(float(borders.at[country_code, column]) for column in ('xmin', 'ymin', 'xmax', 'ymax'))
+
+def country_areas(**kwargs):
+    """Area in km² per nuts code, see load_borders for kwargs."""
+    return load_borders(**kwargs)['area_km2'].to_dict()
@@ -0,0 +1,96 @@
+"""
+Shared, pooled connection layer for the ETAIN database. One SQLAlchemy
+engine is created per process and reused by every query, instead of a
+new engine per call. Worker processes that inherit an engine from their
+parent (fork) get their own engine on first use.
+
+The connection URL is built from db_secrets.EtainDB, unless the
+ETAIN_DB_URL environment variable is set (e.g. for a local PostGIS).
+The pool size is read from ETAIN_DB_POOL_SIZE and ETAIN_DB_MAX_OVERFLOW
+(see configure_pool), so it also reaches spawned worker processes.
+"""
+
+import atexit
+import os
+from urllib.parse import quote
+
+from sqlalchemy import create_engine
+
+POOL_SIZE_ENV = 'ETAIN_DB_POOL_SIZE'
+MAX_OVERFLOW_ENV = 'ETAIN_DB_MAX_OVERFLOW'
+#defaults when the environment variables are not set
+POOL_SIZE = 5
+MAX_OVERFLOW = 5
+
+_engine = None
+_engine_pid = None
+
+
+def database_url():
+    """
+    Build the PostgreSQL connection URL.
+
+    Returns:
+        str: ETAIN_DB_URL if set, otherwise the URL from db_secrets.
+    """
+    if os.environ.get('ETAIN_DB_URL'):
+        return os.environ['ETAIN_DB_URL']
+
+    import db_secrets
+    db_creds = db_secrets.EtainDB()
+
+    user = quote(db_creds.db_user)
+    password = quote(db_creds.db_pass)
+    host = db_creds.db_address
+    port = db_creds.db_port
+    db_name = db_creds.db_name
+
+    return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
+
+def configure_pool(pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW):
+    """
+    Set the pool size for engines created after this call, in this
+    process and the worker processes started after it. Disposes the
+    current engine of this process, if any.
+
+    Args:
+        pool_size (int): Connections kept open per process.
+        max_overflow (int): Extra connections allowed under load.
+    """
+    os.environ[POOL_SIZE_ENV] = str(pool_size)
+    os.environ[MAX_OVERFLOW_ENV] = str(max_overflow)
+    dispose_engine()
+
+def get_engine():
+    """
+    Return the pooled engine of this process, creating it on first use.
+
+    Returns:
+        sqlalchemy.engine.base.Engine: Engine with pre-ping enabled, so
+        connections dropped by the server are replaced transparently.
+    """
+    global _engine, _engine_pid
+    if _engine is not None and _engine_pid != os.getpid():
+        #inherited from the parent process: leave the parent's connections alone
+        _engine.dispose(close=False)
+        _engine = None
+
+    if _engine is None:
+        _engine = create_engine(
+            database_url(),
+            pool_size=int(os.environ.get(POOL_SIZE_ENV, POOL_SIZE)),
+            max_overflow=int(os.environ.get(MAX_OVERFLOW_ENV, MAX_OVERFLOW)),
+            pool_pre_ping=True
+        )
+        _engine_pid = os.getpid()
+    return _engine
+
+def dispose_engine():
+    """Close all pooled connections of this process."""
+    global _engine, _engine_pid
+    if _engine is not None and _engine_pid == os.getpid():
+        _engine.dispose()
+    _engine = None
+    _engine_pid = None
+
+atexit.register(dispose_engine)
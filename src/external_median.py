@@ -0,0 +1,169 @@
+"""
+Out-of-core variant of binning.provider_cell_sums for countries whose
+measurements do not fit in memory together with the sort of the binning
+engine. Measurements are staged to a file on disk chunk by chunk, as
+(x, y, provider, mW) records. When the grid is known, the staged records
+are cut into runs of RUN_ROWS, every run gets its (provider, cell) keys,
+is sorted and written to a memory mapped run file, and the runs are
+k-way merged block by block. Every merged block holds complete
+(provider, cell) groups, whose exact medians are taken with
+binning.cell_medians, so the result equals the in-memory engine value
+for value.
+
+create_exposure_array and the ProviderGridAccumulator switch to this
+mode above EXTERNAL_MEDIAN_ROWS rows, which can be set with the
+ETAIN_EXTERNAL_MEDIAN_ROWS environment variable. The files are written
+to the temporary folder (TMPDIR).
+"""
+
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import binning
+
+EXTERNAL_MEDIAN_ROWS_ENV = 'ETAIN_EXTERNAL_MEDIAN_ROWS'
+EXTERNAL_MEDIAN_ROWS = int(os.environ.get(EXTERNAL_MEDIAN_ROWS_ENV, 50_000_000))
+RUN_ROWS = 5_000_000
+MERGE_BLOCK_ROWS = 1_000_000
+
+STAGED_DTYPE = np.dtype([('x', 'f8'), ('y', 'f8'), ('value', 'f8'), ('provider', 'i4')])
+RUN_DTYPE = np.dtype([('key', 'i8'), ('value', 'f8')])
+
+
+def merged_blocks(runs, block_rows=MERGE_BLOCK_ROWS):
+    """
+    k-way merge of sorted runs, block by block.
+
+    Args:
+        runs (list): RUN_DTYPE arrays (memory maps) sorted by key.
+        block_rows (int): Rows read from a run per step.
+
+    Yields:
+        tuple: (keys, values) of increasing key ranges. Every key is in
+        exactly one block, but a block is not sorted itself.
+    """
+    positions = [0] * len(runs)
+    while True:
+        active = [i for i, run in enumerate(runs) if positions[i] < len(run)]
+        if not active:
+            return
+        #keys below the smallest last key of the runs that do not fit into a block are complete
+        limits = [runs[i]['key'][positions[i] + block_rows - 1] for i in active
+                  if positions[i] + block_rows < len(runs[i])]
+        bound = min(limits) if limits else None
+        ends = {}
+        for i in active:
+            keys = runs[i]['key'][positions[i]:]
+            ends[i] = len(runs[i]) if bound is None else positions[i] + int(np.searchsorted(keys, bound, 'left'))
+        if bound is not None and all(ends[i] == positions[i] for i in active):
+            #one group fills a whole block, take all of it
+            for i in active:
+                ends[i] = positions[i] + int(np.searchsorted(runs[i]['key'][positions[i]:], bound, 'right'))
+
+        parts = [runs[i][positions[i]:ends[i]] for i in active if ends[i] > positions[i]]
+        for i in active:
+            positions[i] = ends[i]
+        block = np.concatenate(parts)
+        yield block['key'], block['value']
+
+class SpilledMeasurements:
+    """
+    Measurements of a country staged on disk, the out-of-core stand-in for
+    the df passed to create_exposure_array. Providers are coded in order
+    of first appearance, like binning.provider_cell_sums does, so the
+    providers are summed in the same order.
+    """
+
+    def __init__(self, spill_folder=None):
+        self._folder = tempfile.TemporaryDirectory(prefix='etain_spill_', dir=spill_folder)
+        self._staged_path = os.path.join(self._folder.name, 'staged.bin')
+        self._providers = {}
+        self.row_count = 0
+        self.bounds = (np.inf, np.inf, -np.inf, -np.inf)
+
+    @classmethod
+    def from_frame(cls, df, chunk_rows=RUN_ROWS, spill_folder=None):
+        """Stage a DataFrame with x, y, DIRECT_connection_mcc_mnc and LTE_mW_total."""
+        spilled = cls(spill_folder)
+        for start in range(0, len(df), chunk_rows):
+            spilled.add(df.iloc[start:start + chunk_rows])
+        return spilled
+
+    def add(self, df_mw):
+        """Stage a chunk that went through convert_dBm_to_mW."""
+        if df_mw.empty:
+            return
+        codes, uniques = pd.factorize(df_mw['DIRECT_connection_mcc_mnc'], sort=False)
+        provider_codes = np.array([self._providers.setdefault(provider, len(self._providers))
+                                   for provider in uniques] + [-1], dtype=np.int32)
+
+        records = np.empty(len(df_mw), dtype=STAGED_DTYPE)
+        records['x'] = df_mw['x'].to_numpy(dtype=np.float64)
+        records['y'] = df_mw['y'].to_numpy(dtype=np.float64)
+        records['value'] = df_mw['LTE_mW_total'].to_numpy(dtype=np.float64)
+        records['provider'] = provider_codes[codes]
+        with open(self._staged_path, 'ab') as f:
+            records.tofile(f)
+
+        xmin, ymin, xmax, ymax = self.bounds
+        self.bounds = (min(xmin, np.nanmin(records['x'])), min(ymin, np.nanmin(records['y'])),
+                       max(xmax, np.nanmax(records['x'])), max(ymax, np.nanmax(records['y'])))
+        self.row_count += len(records)
+
+    def _write_runs(self, x_edges, y_edges, run_rows):
+        nrows = len(y_edges) - 1
+        n_cells = (len(x_edges) - 1) * nrows
+        staged = np.memmap(self._staged_path, dtype=STAGED_DTYPE, mode='r')
+        paths = []
+        for start in range(0, len(staged), run_rows):
+            records = staged[start:start + run_rows]
+            xi = binning.bin_indices(records['x'], x_edges)
+            yi = binning.bin_indices(records['y'], y_edges)
+            inside = (xi >= 0) & (yi >= 0) & (records['provider'] >= 0)
+
+            run = np.empty(int(inside.sum()), dtype=RUN_DTYPE)
+            run['key'] = records['provider'][inside].astype(np.int64) * n_cells + xi[inside] * nrows + yi[inside]
+            run['value'] = records['value'][inside]
+            run = run[np.lexsort((run['value'], run['key']))]
+
+            path = os.path.join(self._folder.name, f'run_{len(paths)}.bin')
+            run.tofile(path)
+            paths.append(path)
+        del staged
+        return paths
+
+    def provider_cell_sums(self, x_edges, y_edges, run_rows=RUN_ROWS, block_rows=MERGE_BLOCK_ROWS):
+        """
+        Out-of-core binning.provider_cell_sums over the staged measurements,
+        with the same arguments and result.
+        """
+        print(f'Sorting {self.row_count} measurements in runs of {run_rows} on disk...')
+        n_cells = (len(x_edges) - 1) * (len(y_edges) - 1)
+        paths = self._write_runs(x_edges, y_edges, run_rows) if self.row_count else []
+        runs = [np.memmap(path, dtype=RUN_DTYPE, mode='r') if os.path.getsize(path) else np.empty(0, RUN_DTYPE)
+                for path in paths]
+
+        #medians come out sorted by provider and cell, as the blocks cover increasing keys
+        group_parts, cell_parts, median_parts = [], [], []
+        for keys, values in merged_blocks(runs, block_rows):
+            group_ids, cell_ids, medians = binning.cell_medians(keys // n_cells, keys % n_cells, values)
+            group_parts.append(group_ids)
+            cell_parts.append(cell_ids)
+            median_parts.append(medians)
+        del runs
+        for path in paths:
+            os.remove(path)
+
+        if not median_parts:
+            return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0)
+        group_ids, cell_ids = np.concatenate(group_parts), np.concatenate(cell_parts)
+        unique_cells, positions = np.unique(cell_ids, return_inverse=True)
+        sums, counts = binning.sum_group_medians(group_ids, positions, np.concatenate(median_parts), len(unique_cells))
+        return unique_cells, sums, counts
+
+    def cleanup(self):
+        """Remove the staged files. Also done when the object is garbage collected."""
+        self._folder.cleanup()
@@ -0,0 +1,112 @@
+"""
+Local on-disk cache of normalized country frames (the output of
+add_frequency_colums and normalize_ssi), so reruns of process_country
+with other calibration or cell size settings do not hit the database or
+repeat the normalization.
+
+Frames are stored as uncompressed Feather (Arrow IPC) files, which are
+read back memory-mapped, so the Arrow side of a read stays in the page
+cache. The reads are not zero-copy: the conversion to pandas copies
+every column into process memory once (NaN filled floats, nullable Int32
+EARFCNs and the categorical provider have no Arrow layout pandas can
+share), so a read costs about one frame of process memory, where a read
+without the memory map costs two.
+
+A cache entry is keyed by country, ssi, a hash of the query, the EARFCN
+band table and CACHE_VERSION, and the data watermark (latest measurement
+ts in the database), so new measurements or a changed query invalidate
+it. The least recently used entries are evicted once the cache grows
+beyond max_bytes.
+
+The watermark is a MAX(ts) over appdata.measurementdata on every lookup,
+which needs an index on ts (see sql_queries.create_ts_index) to be an
+index lookup instead of a full scan.
+
+pyarrow is optional: without it the cache is disabled.
+"""
+
+import glob
+import hashlib
+import os
+import re
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+
+CACHE_FOLDER = os.path.join('data', 'private', 'cache')
+MAX_CACHE_BYTES = 20 * 1024**3
+#bump when the cached frame layout or the normalization changes
+CACHE_VERSION = '2'
+
+
+def cache_key(country_code, ssi, query, watermark, mapping_path):
+    """
+    Build the cache file name of a normalized country frame.
+
+    Args:
+        query (str): SQL the frame was fetched with.
+        watermark: Latest measurement ts in the database.
+        mapping_path (str): EARFCN band table used for the frequencies.
+
+    Returns:
+        str: File name, unique for the inputs of the frame.
+    """
+    digest = hashlib.sha256()
+    digest.update(CACHE_VERSION.encode())
+    digest.update(query.encode())
+    with open(mapping_path, 'rb') as f:
+        digest.update(f.read())
+    watermark = re.sub(r'[^0-9A-Za-z]+', '', str(watermark))
+    return f'{country_code}_{ssi}_{digest.hexdigest()[:16]}_{watermark}.feather'
+
+def load(key, cache_folder=CACHE_FOLDER):
+    """
+    Read a cached frame, memory-mapped.
+
+    Returns:
+        pandas.DataFrame or None: The frame, or None on a cache miss.
+    """
+    path = os.path.join(cache_folder, key)
+    if pa is None or not os.path.exists(path):
+        return None
+
+    print(f'Reading cached frame {key}...')
+    table = feather.read_table(path, memory_map=True)
+    os.utime(path)  #mark as recently used for eviction
+    return table.to_pandas()
+
+def store(key, df, cache_folder=CACHE_FOLDER, max_bytes=MAX_CACHE_BYTES):
+    """
+    Write a frame to the cache and evict old entries beyond max_bytes.
+    Frames that Arrow cannot store (e.g. mixed type object columns) are
+    skipped.
+    """
+    if pa is None:
+        print('pyarrow not installed, frame cache disabled')
+        return
+
+    os.makedirs(cache_folder, exist_ok=True)
+    path = os.path.join(cache_folder, key)
+    try:
+        feather.write_feather(df.reset_index(drop=True), path + '.tmp', compression='uncompressed')
+    except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+        print(f'Frame not cached: {e}')
+        if os.path.exists(path + '.tmp'):
+            os.remove(path + '.tmp')
+        return
+    os.replace(path + '.tmp', path)
+    evict(cache_folder, max_bytes)
+
+def evict(cache_folder=CACHE_FOLDER, max_bytes=MAX_CACHE_BYTES):
+    """Delete the least recently used cache files until the cache fits max_bytes."""
+    files = sorted(glob.glob(os.path.join(cache_folder, '*.feather')), key=os.path.getmtime)
+    total = sum(os.path.getsize(f) for f in files)
+    for f in files:
+        if total <= max_bytes:
+            break
+        total -= os.path.getsize(f)
+        os.remove(f)
+        print(f'Evicted {os.path.basename(f)} from frame cache')
@@ -1,134 +1,338 @@
-import psycopg2
 import geopandas as gpd
 import pandas as pd
-from shapely.geometry import Point
-from sqlalchemy import create_engine
-import urllib.parse
+import numpy as np
+from pyproj import Transformer
 from datetime import datetime,date,timedelta
 import os
-import glob
-
-import db_secrets
-
-today = date.today().strftime("%d%m%Y")
-output_folder = f'data/private/output/{today}'
-
-###TODO: MULTITHREADING BOTH GENERATION AND MERGING
-#db connection
-db_creds = db_secrets.EtainDB()
-db_params = {
-    'dbname': db_creds.db_name,
-    'user': db_creds.db_user,
-    'password': db_creds.db_pass,
-    'host': db_creds.db_address,
-    'port': db_creds.db_port
-}
-
-countries = ['AT','AD','AL','BA',       ###SKIPPING FOR NOW: 
-             'BE','BG','CH','CY',       
-             'CZ','DE','DK','EE','EL',  ###'RU','GE','AZ','TR','BY','GI': NOT EU
-             'ES','FI','FR','GG',       ### 'US'          
-             'HR','HU','IE','IM',       
-             'IS','IT','JE','LI','LT',
-             'LU','LV','MC','MD','ME',
-             'MK','MT','NL','NO','PL',
-             'PT','RO','RS','SE',
-             'SI','SK','SM','UK',
-             'UA','VA','XK']
-
-conn = psycopg2.connect(**db_params)
-
-# Fetch measurement data 
-print('Fetching all measurements')
-measurement_query = '''
-    SELECT "LOC_longitude", "LOC_latitude" FROM appdata.measurementdata
-    WHERE "LOC_longitude" IS NOT NULL AND ("LTE_0_rssi" IS NOT NULL OR "LTE_0_rsrp" IS NOT NULL)
-'''
-
-with conn.cursor() as cur:
-    cur.execute(measurement_query)
-    measurement_data = cur.fetchall()
-
-measurement_df = pd.DataFrame(measurement_data, columns=['LOC_longitude', 'LOC_latitude'])
-
-if measurement_df.empty:
-    print('No measurements found, exiting.')
-    exit()
-
-print('Creating geometries for measurements')
-measurement_df['geom'] = measurement_df.apply(lambda row: Point(row['LOC_longitude'], row['LOC_latitude']), axis=1)
-measurement_gdf = gpd.GeoDataFrame(measurement_df, geometry='geom', crs="EPSG:4326")
-print(f'Matching CRS')
-measurement_gdf_transformed = measurement_gdf.to_crs("EPSG:3857")
-
-
-
-for country in countries:
+import concurrent.futures
+import traceback
+
+import db_connection
+import sql_queries
+
+#'client': count in Python (count_points_in_hexgrid), 'server': count in PostGIS.
+#The engines only differ for points exactly on a cell border: the client counts
+#them in one neighbouring cell, the server (ST_Contains) in none
+COUNT_ENGINES = ('client', 'server')
+
+#tolerance on the axial coordinates of the cell centers, in cells
+HEX_LAYOUT_TOLERANCE = 1e-3
+
+
+def fetch_measurement_points(engine):
+    """
+    Fetch the location of every LTE measurement.
+
+    Returns:
+        tuple: (longitude, latitude) numpy arrays in EPSG:4326.
+    """
+    #pooled DBAPI connection for the measurement cursor
+    conn = engine.raw_connection()
+
+    # Fetch measurement data
+    print('Fetching all measurements')
+    measurement_query = '''
+        SELECT "LOC_longitude", "LOC_latitude" FROM appdata.measurementdata
+        WHERE "LOC_longitude" IS NOT NULL AND ("LTE_0_rssi" IS NOT NULL OR "LTE_0_rsrp" IS NOT NULL)
+    '''
+    try:
+        with conn.cursor() as cur:
+            cur.execute(measurement_query)
+            measurement_data = cur.fetchall()
+    finally:
+        conn.close()
+
+    measurement_df = pd.DataFrame(measurement_data, columns=['LOC_longitude', 'LOC_latitude'], dtype='float64')
+    return measurement_df['LOC_longitude'].to_numpy(), measurement_df['LOC_latitude'].to_numpy()
+
+def project_points(lon, lat, crs):
+    """Transform EPSG:4326 coordinates to crs, without building geometries."""
+    transformer = Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+    return transformer.transform(lon, lat)
+
+def _axial_coordinates(x, y, layout):
+    #fractional axial coordinates (q, r) relative to the origin cell
+    x = (x - layout['origin_x']) / layout['size']
+    y = (y - layout['origin_y']) / layout['size']
+    if layout['flat']:
+        return 2 / 3 * x, -x / 3 + np.sqrt(3) / 3 * y
+    return np.sqrt(3) / 3 * x - y / 3, 2 / 3 * y
+
+def _round_axial(q, r):
+    #round to the nearest hexagon in cube coordinates (q, r, s) with q + r + s = 0
+    s = -q - r
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq = np.where(fix_q, -rr - rs, rq)
+    rr = np.where(fix_r, -rq - rs, rr)
+    return rq.astype(np.int64), rr.astype(np.int64)
+
+def hex_ids(x, y, layout):
+    """
+    Axial hexagon id of each point, as one int64 key per point.
+
+    Args:
+        x, y (numpy.ndarray): Coordinates in the CRS of the hexgrid.
+        layout (dict): See hex_layout.
+    """
+    q, r = _round_axial(*_axial_coordinates(np.asarray(x, dtype=np.float64),
+                                            np.asarray(y, dtype=np.float64), layout))
+    return q * (1 << 32) + r
+
+def hex_layout(grid_gdf):
+    """
+    Derive origin, size and orientation of a regular hexgrid from its
+    cells, so points can be assigned to cells arithmetically.
+
+    Returns:
+        dict: origin_x, origin_y (center of the first cell), size (center
+        to corner distance) and flat (flat-topped or pointy-topped), or None
+        if the cells do not form a regular, axis aligned hexgrid. Cells
+        stored as single part MultiPolygons are accepted.
+    """
+    if grid_gdf.empty:
+        return None
+    cells = grid_gdf.geometry
+    multi = (cells.geom_type == 'MultiPolygon').to_numpy()
+    if multi.any() and any(len(cell.geoms) != 1 for cell in cells[multi]):
+        #cells split into several parts are not regular hexagons
+        return None
+    first = cells.iloc[0].geoms[0] if multi[0] else cells.iloc[0]
+    center = first.centroid
+    corners = np.asarray(first.exterior.coords)[:-1]
+    if len(corners) != 6:
+        return None
+    dx, dy = corners[:, 0] - center.x, corners[:, 1] - center.y
+    size = np.hypot(dx, dy).mean()
+    centers = grid_gdf.geometry.centroid
+
+    for flat in (True, False):
+        layout = {'origin_x': center.x, 'origin_y': center.y, 'size': size, 'flat': flat}
+        #every cell center must lie on the axial lattice of this layout
+        q, r = _axial_coordinates(centers.x.to_numpy(), centers.y.to_numpy(), layout)
+        on_lattice = (np.abs(q - np.round(q)).max() < HEX_LAYOUT_TOLERANCE
+                      and np.abs(r - np.round(r)).max() < HEX_LAYOUT_TOLERANCE)
+        if on_lattice and len(np.unique(hex_ids(centers.x, centers.y, layout))) == len(grid_gdf):
+            return layout
+    return None
+
+def count_points_in_hexgrid(grid_gdf, x, y):
+    """
+    Count the points in each cell of a hexgrid.
+
+    For a regular hexgrid the cell of each point is computed from its
+    axial hexagon id and counted with np.bincount, without a spatial join.
+    Points on a cell border are counted in one of the neighbouring cells.
+    Other grids fall back to a spatial join, which like the server engine
+    (sql_queries.hexgrid_counts) does not count points on a border.
+
+    Args:
+        grid_gdf (GeoDataFrame): Hexgrid cells.
+        x, y (numpy.ndarray): Point coordinates in the CRS of the grid.
+
+    Returns:
+        numpy.ndarray: Point count per row of grid_gdf.
+    """
+    layout = hex_layout(grid_gdf)
+    if layout is None:
+        print('Grid is not a regular hexgrid, counting with a spatial join')
+        points = gpd.GeoDataFrame(geometry=gpd.points_from_xy(x, y), crs=grid_gdf.crs)
+        joined = gpd.sjoin(points, grid_gdf.reset_index(drop=True)[['geom']], how='inner', predicate='within')
+        return np.bincount(joined['index_right'].to_numpy(), minlength=len(grid_gdf))
+
+    #only points inside the grid extent can fall in a cell
+    xmin, ymin, xmax, ymax = grid_gdf.total_bounds
+    inside = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+
+    centers = grid_gdf.geometry.centroid
+    cell_keys = hex_ids(centers.x, centers.y, layout)
+    order = np.argsort(cell_keys)
+    sorted_keys = cell_keys[order]
+
+    point_keys = hex_ids(x[inside], y[inside], layout)
+    positions = np.searchsorted(sorted_keys, point_keys)
+    positions[positions == len(sorted_keys)] = 0
+    matched = sorted_keys[positions] == point_keys
+    return np.bincount(order[positions[matched]], minlength=len(grid_gdf))
+
+def grid_extent(engine, country):
+    """
+    Extent and SRID of the hexgrid of a country, computed in PostGIS.
+
+    Returns:
+        tuple: (xmin, ymin, xmax, ymax, srid), or None for an empty grid.
+    """
+    extent_query = f'''
+        SELECT ST_XMin(e) AS xmin, ST_YMin(e) AS ymin, ST_XMax(e) AS xmax, ST_YMax(e) AS ymax,
+               (SELECT ST_SRID(geom) FROM hexagon_grids."{country}_hexgrid_500m" LIMIT 1) AS srid
+        FROM (SELECT ST_Extent(geom) AS e FROM hexagon_grids."{country}_hexgrid_500m") AS extent
+    '''
+    row = pd.read_sql(extent_query, engine).iloc[0]
+    if pd.isna(row['xmin']):
+        return None
+    return row['xmin'], row['ymin'], row['xmax'], row['ymax'], int(row['srid'])
+
+def partition_points(lon, lat, extents):
+    """
+    Split the measurements by hexgrid extent, so every country job only
+    gets the points that can fall in its grid. Points are projected once
+    per grid CRS and sorted by x, each extent is then a binary search plus
+    a filter on y. Points in overlapping extents go to all these countries.
+
+    Args:
+        lon, lat (numpy.ndarray): Measurement locations in EPSG:4326.
+        extents (dict): {country: (xmin, ymin, xmax, ymax, srid)}
+
+    Returns:
+        dict: {country: (x, y)} in the CRS of the country's grid.
+    """
+    partitions = {}
+    for srid in sorted({extent[4] for extent in extents.values()}):
+        x, y = project_points(lon, lat, f'EPSG:{srid}')
+        order = np.argsort(x, kind='stable')
+        x, y = x[order], y[order]
+        for country, (xmin, ymin, xmax, ymax, country_srid) in extents.items():
+            if country_srid != srid:
+                continue
+            start = np.searchsorted(x, xmin, side='left')
+            end = np.searchsorted(x, xmax, side='right')
+            in_extent = (y[start:end] >= ymin) & (y[start:end] <= ymax)
+            partitions[country] = (x[start:end][in_extent], y[start:end][in_extent])
+    return partitions
+
+def country_counts(country, x, y):
+    """
+    Count the measurements in the 500 m hexgrid of a country.
+
+    Args:
+        x, y (numpy.ndarray): Measurement locations in the CRS of the grid,
+        see partition_points.
+
+    Returns:
+        GeoDataFrame: fid, point_count, geom and country per grid cell.
+    """
     print(f'Fetching grid for {country}')
     grid_query = f'SELECT fid, geom FROM hexagon_grids."{country}_hexgrid_500m"'
-    grid_gdf = gpd.GeoDataFrame.from_postgis(grid_query, conn, geom_col='geom')
-    
+    grid_gdf = gpd.GeoDataFrame.from_postgis(grid_query, db_connection.get_engine(), geom_col='geom')
 
-    
     print(f'Counting measurements in grid cells for {country}')
-    result_gdf = gpd.sjoin(grid_gdf, measurement_gdf_transformed, how='left', predicate='contains')
-    result_gdf['point_count'] = result_gdf.index_right.notna().astype(int)
+    result_counts = grid_gdf[['fid']].copy()
+    result_counts['point_count'] = count_points_in_hexgrid(grid_gdf, x, y).astype(int)
+    result_counts['geom'] = grid_gdf['geom']
+    result_counts = gpd.GeoDataFrame(result_counts, geometry='geom', crs=grid_gdf.crs)
+    result_counts['country'] = country
+    return result_counts.sort_values('fid').reset_index(drop=True)
 
-    result_counts = result_gdf.groupby('fid').agg(
-        point_count=('index_right', lambda x: x.notna().sum()),
-        geom=('geom', 'first')
-    ).reset_index()
+def country_counts_server(country):
+    """
+    Count the measurements in the 500 m hexgrid of a country in PostGIS
+    (sql_queries.hexgrid_counts). Only the counts and cell geometries are
+    transferred. Points exactly on a cell border are not counted, see
+    count_points_in_hexgrid for the client engine.
 
-    result_counts = gpd.GeoDataFrame(result_counts, geometry='geom', crs=grid_gdf.crs)
-    result_counts['point_count'] = result_counts['point_count'].fillna(0).astype(int)
-    result_counts['country'] = country 
-
-
-    if result_counts.empty:
-        print(f'No measurement data to save for {country}, skipping.')
-        continue
-
-    output_path = f'{output_folder}/counts{country}.gpkg'
-    result_counts.to_file(output_path, driver='GPKG')
-
-    print(f'Saved results for {country}')
-        
-    del grid_gdf, result_gdf, result_counts
-
-###TODO: MULTITHREADING BOTH GENERATION AND MERGING
-#write to gpkg
-output_gpkg = f"{output_folder}/count_merged.gpkg"
-layer_name = "count"
-
-gdfs = []
-
-for file in os.listdir(output_folder):
-    if "metadata" in file:
-        continue
-    if file.endswith(".gpkg"):
-        print(file)
-        file_path = os.path.join(output_folder, file)
-        
-        gdf = gpd.read_file(file_path)
-        
-        gdfs.append(gdf)
-
-if gdfs:
-    print('merging gdf')
-    merged_gdf = pd.concat(gdfs, ignore_index=True)
-
-    print('saving to merged gpkg')
-    merged_gdf.to_file(output_gpkg, layer=layer_name, driver="GPKG")
-    print(f"Successfully merged {len(merged_gdf)} features into {output_gpkg}")
-
-else:
-    print("No valid data found to merge.")
-
-# Delete .gpkg files that don't contain "merged" or "metadata"
-for file in glob.glob(os.path.join(output_folder, "*.gpkg")):
-    name = os.path.basename(file)
-    if "merged" not in name and "metadata" not in name:
-        os.remove(file)
-        print(f"Deleted: {file}")
-
-print('script completed')
\ No newline at end of file
+    Returns:
+        GeoDataFrame: fid, point_count, geom and country per grid cell, like
+        country_counts.
+    """
+    print(f'Counting measurements in grid cells for {country} in PostGIS')
+    result_counts = gpd.GeoDataFrame.from_postgis(sql_queries.hexgrid_counts(country),
+                                                  db_connection.get_engine(), geom_col='geom')
+    result_counts['point_count'] = result_counts['point_count'].astype(int)
+    result_counts['country'] = country
+    return result_counts
+
+def _client_jobs(countries):
+    engine = db_connection.get_engine()
+    lon, lat = fetch_measurement_points(engine)
+    if len(lon) == 0:
+        print('No measurements found, exiting.')
+        return {}
+
+    extents = {}
+    for country in countries:
+        extent = grid_extent(engine, country)
+        if extent is None:
+            print(f'No measurement data to save for {country}, skipping.')
+            continue
+        extents[country] = extent
+    return partition_points(lon, lat, extents)
+
+def count_countries(countries, output_gpkg, layer_name='count', max_workers=None, count_engine='client'):
+    """
+    Count the measurements of all countries on a process pool and append
+    each country's counts to one GeoPackage layer as soon as it is done.
+
+    Args:
+        count_engine (str): 'client' fetches all measurement locations and
+        counts them per country in Python, 'server' runs one counting query
+        per country in PostGIS.
+
+    Returns:
+        tuple: (number of features written, failures as (country, error message))
+    """
+    if count_engine not in COUNT_ENGINES:
+        raise ValueError(f'unknown count engine {count_engine}, expected one of {COUNT_ENGINES}')
+    if count_engine == 'client':
+        partitions = _client_jobs(countries)
+        jobs = {country: (country_counts, country, *partitions.pop(country)) for country in list(partitions)}
+    else:
+        jobs = {country: (country_counts_server, country) for country in countries}
+
+    if os.path.exists(output_gpkg):
+        os.remove(output_gpkg)
+    written = 0
+    failures = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(*job): country for country, job in jobs.items()}
+        for future in concurrent.futures.as_completed(futures):
+            country = futures[future]
+            try:
+                result_counts = future.result()
+            except Exception as e:
+                print(f'{country} failed:')
+                traceback.print_exc()
+                failures.append((country, repr(e)))
+                continue
+
+            if result_counts.empty:
+                print(f'No measurement data to save for {country}, skipping.')
+                continue
+            #own FID column, the grid fid is only unique within a country
+            result_counts.to_file(output_gpkg, layer=layer_name, driver='GPKG', mode='a' if written else 'w',
+                                  FID='gpkg_fid')
+            written += len(result_counts)
+            print(f'Saved results for {country}')
+    return written, failures
+
+
+if __name__ == '__main__':
+
+    today = date.today().strftime("%d%m%Y")
+    output_folder = f'data/private/output/{today}'
+
+    countries = ['AT','AD','AL','BA',       ###SKIPPING FOR NOW:
+                 'BE','BG','CH','CY',
+                 'CZ','DE','DK','EE','EL',  ###'RU','GE','AZ','TR','BY','GI': NOT EU
+                 'ES','FI','FR','GG',       ### 'US'
+                 'HR','HU','IE','IM',
+                 'IS','IT','JE','LI','LT',
+                 'LU','LV','MC','MD','ME',
+                 'MK','MT','NL','NO','PL',
+                 'PT','RO','RS','SE',
+                 'SI','SK','SM','UK',
+                 'UA','VA','XK']
+
+    #write to gpkg
+    output_gpkg = f"{output_folder}/count_merged.gpkg"
+    count_engine = 'client'  #or 'server' to count in PostGIS
+    written, failures = count_countries(countries, output_gpkg, max_workers=os.cpu_count(), count_engine=count_engine)
+    if written:
+        print(f"Successfully merged {written} features into {output_gpkg}")
+    else:
+        print("No valid data found to merge.")
+    for country, error in failures:
+        print(f'{country} failed: {error}')
+
+    print('script completed')
@@ -5,42 +5,149 @@ import numpy as np
 import scipy.stats
 import rasterio as rio
 from rasterio.merge import merge
+from rasterio.shutil import copy as rio_copy
 from rasterio.enums import Resampling
 from rasterio.warp import calculate_default_transform, reproject
-from urllib.parse import quote
-from sqlalchemy import create_engine
 from datetime import datetime
 from osgeo import gdal
 import os
 import glob
+import functools
 
-import db_secrets
+import db_connection
+import frame_cache
 import sql_queries
+import binning
+import external_median
 
 gdal.UseExceptions()
 gdal.PushErrorHandler('CPLQuietErrorHandler')
 
+EARFCN_MAPPING_PATH = os.path.join('data', 'earfcn_frequency_ranges.csv')
+RASTER_TILE_SIZE = 512
+
+#compact dtypes of the measurement frame, enforced at fetch time
+EARFCN_DTYPE = 'Int32'  #nullable, EARFCNs can be missing
+VALUE_DTYPE = np.float32  #ssi, frequency and mW values
+PROVIDER_DTYPE = 'category'
+RASTER_OVERVIEW_RESAMPLING = 'average'
+
 def _postgres_connect():
     """
-    Create a connection to the PostgreSQL database using SQLAlchemy.
+    Get the shared, pooled connection to the PostgreSQL database.
 
     Returns:
-        sqlalchemy.engine.base.Engine: A SQLAlchemy engine instance 
-        connected to the specified PostgreSQL database.
+        sqlalchemy.engine.base.Engine: The SQLAlchemy engine of this 
+        process, see db_connection.get_engine.
     """
-    db_creds = db_secrets.EtainDB()
+    return db_connection.get_engine()
 
-    user = quote(db_creds.db_user)
-    password = quote(db_creds.db_pass)
-    host = db_creds.db_address
-    port = db_creds.db_port
-    db_name = db_creds.db_name
+_subdivided_borders_ready = False
+
+def ensure_subdivided_borders(refresh=False):
+    """
+    Create the subdivided border table used by the indexed country filter
+    if it does not exist yet, once per process (see 
+    sql_queries.create_subdivided_borders). Call it before starting the
+    workers: concurrent CREATE TABLE IF NOT EXISTS statements fail on each
+    other, so the workers only check the table (check_subdivided_borders).
+    """
+    global _subdivided_borders_ready
+    if _subdivided_borders_ready and not refresh:
+        return
+    with _postgres_connect().begin() as conn:
+        conn.exec_driver_sql(sql_queries.create_subdivided_borders(refresh=refresh))
+    _subdivided_borders_ready = True
+
+def check_subdivided_borders():
+    """
+    Raise a RuntimeError if the subdivided border table does not exist,
+    checked once per process.
+    """
+    global _subdivided_borders_ready
+    if _subdivided_borders_ready:
+        return
+    with _postgres_connect().connect() as conn:
+        exists = conn.exec_driver_sql(sql_queries.subdivided_borders_exist()).scalar()
+    if not exists:
+        raise RuntimeError(f'{sql_queries.SUBDIVIDED_BORDERS_TABLE} does not exist, '
+                           'create it with ensure_subdivided_borders before starting the workers')
+    _subdivided_borders_ready = True
+
+_earfcn_frequency_ready = False
+
+def ensure_earfcn_frequency(refresh=False):
+    """
+    Create the EARFCN frequency table of the server side mW sums and fill
+    it with the valid EARFCNs of _earfcn_frequency_lookup, once per
+    process (see sql_queries.create_earfcn_frequency). Call it before
+    starting the workers, with refresh=True after the band table changed;
+    the workers only check the table (check_earfcn_frequency).
+    """
+    global _earfcn_frequency_ready
+    if _earfcn_frequency_ready and not refresh:
+        return
+    lookup = _earfcn_frequency_lookup()
+    earfcns = np.flatnonzero(~np.isnan(lookup))
+    frequencies = pd.DataFrame({'earfcn': earfcns.astype(np.int32), 'frequency': lookup[earfcns]})
+    with _postgres_connect().begin() as conn:
+        conn.exec_driver_sql(sql_queries.create_earfcn_frequency(refresh=refresh))
+        if refresh or not conn.exec_driver_sql(sql_queries.earfcn_frequency_exists()).scalar():
+            schema, table = sql_queries.EARFCN_FREQUENCY_TABLE.split('.')
+            frequencies.to_sql(table, conn, schema=schema, if_exists='append', index=False,
+                               method='multi', chunksize=10000)
+            conn.exec_driver_sql(f'ANALYZE {sql_queries.EARFCN_FREQUENCY_TABLE}')
+    _earfcn_frequency_ready = True
+
+def check_earfcn_frequency():
+    """
+    Raise a RuntimeError if the EARFCN frequency table does not exist or
+    is empty, checked once per process.
+    """
+    global _earfcn_frequency_ready
+    if _earfcn_frequency_ready:
+        return
+    with _postgres_connect().connect() as conn:
+        exists = conn.exec_driver_sql(sql_queries.earfcn_frequency_exists()).scalar()
+    if not exists:
+        raise RuntimeError(f'{sql_queries.EARFCN_FREQUENCY_TABLE} does not exist, '
+                           'create it with ensure_earfcn_frequency before starting the workers')
+    _earfcn_frequency_ready = True
+
+def measurement_dtypes(ssi_values=(),server_side_mw=False):
+    """
+    Compact dtypes of the measurement frame: float64 coordinates, a
+    categorical network provider, nullable int32 EARFCNs and float32 ssi
+    values. appId and ts keep the types of the driver.
 
-    db_uri = f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
-    engine = create_engine(db_uri)
-    return engine
+    Args:
+        ssi_values (iterable): ssi families in the frame, e.g. ('rsrp',).
+        server_side_mw (bool): dtypes of the country_data_mw frame instead.
 
-def fetch_country_data(country_code,ssi):
+    Returns:
+        dict: {column: dtype}
+    """
+    dtypes = {'x': np.float64, 'y': np.float64, 'DIRECT_connection_mcc_mnc': PROVIDER_DTYPE}
+    if server_side_mw:
+        dtypes['LTE_mW_total'] = VALUE_DTYPE
+        return dtypes
+    for ssi in ssi_values:
+        dtypes.update({f'LTE_{i}_{ssi}': VALUE_DTYPE for i in range(10)})
+    dtypes.update({f'LTE_{i}_earfcn': EARFCN_DTYPE for i in range(10)})
+    return dtypes
+
+def _country_query(country_code,ssi,server_side_mw=False,indexed=False,since=None,optional_columns=()):
+    if indexed:
+        check_subdivided_borders()
+    if server_side_mw:
+        if since is not None or optional_columns:
+            raise ValueError('since and optional_columns are not supported with server_side_mw')
+        check_earfcn_frequency()
+        return sql_queries.country_data_mw(country_code,ssi,indexed=indexed)
+    return sql_queries.country_data(country_code,ssi,indexed=indexed,since=since,
+                                    optional_columns=optional_columns)
+
+def fetch_country_data(country_code,ssi,server_side_mw=False,indexed=False,since=None,optional_columns=()):
     """
     Fetch measurement data for a specified country from the database.
     Constructs a SQL query based on the country code in the database.
@@ -48,21 +155,203 @@ def fetch_country_data(country_code,ssi):
     Args:
         country_code (str): The country code to filter the measurement 
         data.
+        server_side_mw (bool): If True, frequency mapping, normalization,
+        the dBm to mW sum and the provider filtering run in PostgreSQL
+        and only x, y, DIRECT_connection_mcc_mnc and LTE_mW_total are
+        returned, ready for split_dataframes.
+        indexed (bool): If True, use the index friendly country filter
+        on the subdivided borders instead of per row 3857 transforms.
+        since: If set, only fetch measurements with a ts after this 
+        watermark (client side pipeline only).
+        optional_columns (tuple): 'appId' and/or 'ts' to fetch as well
+        (client side pipeline only).
 
     Returns:
         pandas.DataFrame: A DataFrame containing the measurement data 
-        for the specified country, with columns for appId, timestamps,
-        and various LTE ssi values. Geometry is already constructed
-        in the "geom" column
+        for the specified country, with x, y, the network provider and
+        the LTE ssi and earfcn values, in the dtypes of 
+        measurement_dtypes.
     """
     print(f'Fetching data for {country_code}...')
-    query = sql_queries.country_data(country_code,ssi)
-    df = pd.read_sql(query, _postgres_connect())
+    query = _country_query(country_code,ssi,server_side_mw,indexed,since,optional_columns)
+    df = pd.read_sql(query, _postgres_connect(), dtype=measurement_dtypes((ssi,), server_side_mw))
     return df
 
+def fetch_normalized_country_data(country_code,ssi,indexed=False,use_cache=True,
+                                  cache_folder=frame_cache.CACHE_FOLDER):
+    """
+    Fetch the measurement data of a country with frequency columns and 
+    normalized ssi values, i.e. fetch_country_data followed by 
+    add_frequency_colums and normalize_ssi, through the on-disk frame
+    cache (see frame_cache). The cache is valid as long as the query, the
+    band table and the latest measurement ts in the database are unchanged.
+    Every call looks up the latest ts, which needs an index on ts (see
+    sql_queries.create_ts_index).
+
+    Args:
+        country_code (str): The country code to filter the measurement 
+        data.
+        ssi (str): 'rssi' or 'rsrp'.
+        indexed (bool): See fetch_country_data.
+        use_cache (bool): If False, always fetch and normalize again.
+        cache_folder (str): Folder of the cache files.
+
+    Returns:
+        pandas.DataFrame: The normalized measurement data.
+    """
+    query = _country_query(country_code,ssi,indexed=indexed)
+    key = None
+    if use_cache:
+        watermark = pd.read_sql(sql_queries.data_watermark(), _postgres_connect())['watermark'].iloc[0]
+        key = frame_cache.cache_key(country_code, ssi, query, watermark, EARFCN_MAPPING_PATH)
+        df = frame_cache.load(key, cache_folder)
+        if df is not None:
+            return df
+
+    print(f'Fetching data for {country_code}...')
+    df = pd.read_sql(query, _postgres_connect(), dtype=measurement_dtypes((ssi,)))
+    if df.empty:
+        return df
+    df = add_frequency_colums(df)
+    df = normalize_ssi(df, ssi)
+    if key is not None:
+        frame_cache.store(key, df, cache_folder)
+    return df
+
+def fetch_country_data_combined(country_code,ssi_values=('rssi','rsrp'),indexed=False,optional_columns=()):
+    """
+    Fetch the measurement data of a country for several ssi families in
+    one query, see sql_queries.country_data_combined.
+
+    Args:
+        country_code (str): The country code to filter the measurement 
+        data.
+        ssi_values (tuple): ssi families to fetch, e.g. ('rssi', 'rsrp').
+        indexed (bool): See fetch_country_data.
+        optional_columns (tuple): See fetch_country_data.
+
+    Returns:
+        pandas.DataFrame: The columns of fetch_country_data for every 
+        ssi family. Rows of one family are those with LTE_0_{ssi} set.
+    """
+    print(f'Fetching data for {country_code} ({", ".join(ssi_values)})...')
+    if indexed:
+        check_subdivided_borders()
+    query = sql_queries.country_data_combined(country_code,ssi_values,indexed=indexed,
+                                              optional_columns=optional_columns)
+    df = pd.read_sql(query, _postgres_connect(), dtype=measurement_dtypes(ssi_values))
+    return df
+
+def fetch_country_data_chunks(country_code,ssi,chunksize=500000,server_side_mw=False,indexed=False):
+    """
+    Stream measurement data for a specified country from the database in
+    fixed-size chunks. Uses a named server side cursor, so only one chunk
+    is held in memory on the client at a time.
+
+    Args:
+        country_code (str): The country code to filter the measurement 
+        data.
+        ssi (str): 'rssi' or 'rsrp'.
+        chunksize (int): Number of rows per chunk.
+        server_side_mw (bool): See fetch_country_data.
+        indexed (bool): See fetch_country_data.
+
+    Yields:
+        pandas.DataFrame: Chunks with the columns of fetch_country_data.
+    """
+    print(f'Streaming data for {country_code} in chunks of {chunksize} rows...')
+    query = _country_query(country_code,ssi,server_side_mw,indexed)
+
+    #stream_results makes psycopg2 use a named (server side) cursor
+    with _postgres_connect().connect().execution_options(
+        stream_results=True, max_row_buffer=chunksize
+    ) as conn:
+        for chunk in pd.read_sql(query, conn, chunksize=chunksize,
+                                 dtype=measurement_dtypes((ssi,), server_side_mw)):
+            yield chunk
+
+class ProviderGridAccumulator:
+    """
+    Collects the inputs of create_exposure_array per network provider
+    across chunks: x, y and LTE_mW_total as one float64 array per chunk.
+
+    Exact per cell medians need every value, so the values themselves are
+    kept, but at 24 bytes per row instead of the full measurement frame.
+    Providers are kept in order of first appearance, which keeps the
+    summation order of create_exposure_array identical to a full fetch.
+    Above spill_rows rows the values are moved to disk instead, see
+    external_median.
+    """
+
+    def __init__(self, spill_rows=None):
+        self._parts = {}
+        self.row_count = 0
+        self.spill_rows = external_median.EXTERNAL_MEDIAN_ROWS if spill_rows is None else spill_rows
+        self.spilled = None
+
+    def add(self, df_mw):
+        """Add a chunk that went through convert_dBm_to_mW."""
+        self.row_count += len(df_mw)
+        if self.spilled is None and self.row_count > self.spill_rows:
+            print(f'More than {self.spill_rows} rows, spilling the measurements to disk...')
+            self.spilled = external_median.SpilledMeasurements()
+            for provider_df in self._frames():
+                self.spilled.add(provider_df)
+        if self.spilled is not None:
+            self.spilled.add(df_mw)
+            return
+        for provider, provider_df in df_mw.groupby('DIRECT_connection_mcc_mnc', sort=False, observed=True):
+            values = provider_df[['x', 'y', 'LTE_mW_total']].to_numpy(dtype=np.float64)
+            self._parts.setdefault(provider, []).append(values)
+
+    def _frames(self):
+        #one frame per provider in order of first appearance, releases the collected chunks
+        parts, self._parts = self._parts, {}
+        for provider, provider_parts in parts.items():
+            frame = pd.DataFrame(np.concatenate(provider_parts), columns=['x', 'y', 'LTE_mW_total'])
+            frame.insert(2, 'DIRECT_connection_mcc_mnc', provider)
+            yield frame
+
+    def to_frame(self):
+        """
+        Concatenate the collected values into a DataFrame with x, y,
+        DIRECT_connection_mcc_mnc and LTE_mW_total, ordered by provider.
+        Releases the collected chunks. After spilling, returns the
+        external_median.SpilledMeasurements instead, which
+        create_exposure_array takes in place of the DataFrame.
+        """
+        if self.spilled is not None:
+            return self.spilled
+        frames = list(self._frames())
+        if not frames:
+            return pd.DataFrame(columns=['x', 'y', 'DIRECT_connection_mcc_mnc', 'LTE_mW_total'])
+        return pd.concat(frames, ignore_index=True)
+
+def fetch_country_mw_chunked(country_code,ssi,chunksize=500000,server_side_mw=False,indexed=False):
+    """
+    Fetch a country chunk by chunk and run every chunk through frequency
+    mapping, normalization and the dBm to mW conversion, reducing it into
+    a ProviderGridAccumulator. Peak memory of the measurement frame is
+    bounded by the chunk size instead of the country size.
+
+    Returns:
+        tuple: (ProviderGridAccumulator, number of fetched rows)
+    """
+    accumulator = ProviderGridAccumulator()
+    meas_count = 0
+    for chunk in fetch_country_data_chunks(country_code,ssi,chunksize,server_side_mw,indexed):
+        meas_count += len(chunk)
+        if not server_side_mw:
+            chunk = add_frequency_colums(chunk)
+            chunk = normalize_ssi(chunk, ssi)
+            chunk = convert_dBm_to_mW(chunk, ssi)
+        accumulator.add(chunk)
+    return accumulator, meas_count
+
 def convert_dBm_to_mW(df,ssi, column_list=None,copy_columns=False,save_csv=False, ):
     """
-    Function to convert dBm to mW and sum all LTE cells together
+    Function to convert dBm to mW and sum all LTE cells together.
+    copy_columns keeps the dBm values in extra LTE_x_{ssi}_dBm columns.
     """
     print('Converting dBm to mW...')
     if column_list == None:
@@ -73,9 +362,10 @@ def convert_dBm_to_mW(df,ssi, column_list=None,copy_columns=False,save_csv=False
             df[f"{col}_dBm"] = df[col].copy()
 
     for column in column_list:
-        df[column] =  10** (df[column].astype(float)/10)
+        df[column] =  10** (df[column].astype(VALUE_DTYPE)/10)
     
-    df=df.fillna(0)
+    #a categorical provider can't be filled with 0, missing providers are dropped below
+    df=df.fillna({column: 0 for column in df.columns if not isinstance(df[column].dtype, pd.CategoricalDtype)})
     
     df['LTE_mW_total'] = df[column_list].sum(axis=1)
     
@@ -85,7 +375,8 @@ def convert_dBm_to_mW(df,ssi, column_list=None,copy_columns=False,save_csv=False
     ### THIS IS NOT CLEAN OR SUSTAINABLE #TODO FIX
     #drop rows with nonsense network provider data
     row_drops = [0,'x','y']
-    df = df.drop(df[df['DIRECT_connection_mcc_mnc'].isin(row_drops)].index)
+    providers = df['DIRECT_connection_mcc_mnc']
+    df = df.drop(df[providers.isin(row_drops) | providers.isna()].index)
     df = df.reset_index(drop=True)
 
     if save_csv != False:
@@ -109,60 +400,101 @@ def split_dataframes(df):
 
     return split_dfs
 
-def create_exposure_array(df, split_dfs,cell_size):
+def create_exposure_array(df, split_dfs, cell_size, sparse=False, external_median_rows=None, bounds=None):
     """
     Creates an exposure array representing the median LTE mW total values for a specified grid size,
     and sums these values across different network providers.
 
     Parameters:
-    df (DataFrame): The original DataFrame containing 'x', 'y', and 'LTE_mW_total' columns.
-    split_dfs (list of DataFrames): A list of DataFrames, each representing different network providers
-                                     with 'x', 'y', and 'LTE_mW_total' columns.
+    df (DataFrame): The original DataFrame containing 'x', 'y', 'DIRECT_connection_mcc_mnc' and 
+                    'LTE_mW_total' columns.
+    split_dfs (list of DataFrames or None): A list of DataFrames, each representing different network providers
+                                     with 'x', 'y', and 'LTE_mW_total' columns. If None, all providers are
+                                     binned from df in one pass by the binning engine, which gives the same result
+                                     without the per provider copies.
     cell_size: int in georeferences units based on CRS (meters in the case of EPSG:3035)
+    sparse (bool): If True, the sums and counts are returned as binning.SparseGrid objects holding
+                   only the cells with data, instead of dense arrays over the whole bounding box.
+                   Requires split_dfs to be None.
+    external_median_rows (int): With split_dfs None and more rows than this, the medians are taken out of
+                                core (see external_median). Defaults to external_median.EXTERNAL_MEDIAN_ROWS.
+                                df can also be an external_median.SpilledMeasurements.
+    bounds (tuple): (xmin, ymin, xmax, ymax) the grid is laid out over instead of the data bounds, e.g. the
+                    bounding box of the country from country_borders.country_bounds. Measurements outside
+                    the grid are dropped in binning.
 
     Returns:
     numpy.ndarray: A 2D array with the log-transformed sum of median LTE mW total values for each cell.
+    numpy.ndarray: A 2D array with the amount of network providers with data in each cell.
     rasterio.transform.Affine: The affine transform for the generated raster grid.
 
     Notes:
     - The function ensures that zero values are converted to NaN for the final output.
     """
     print('Creating exposure array...')
-    # Define data bounds and grid size
-    xmin, ymin = df['x'].min(), df['y'].min()
-    xmax, ymax = df['x'].max(), df['y'].max()
-
-    # Calculate the number of cells in x and y directions
-    ncols = int(np.ceil((xmax - xmin) / cell_size))
-    nrows = int(np.ceil((ymax - ymin) / cell_size))
-
+    if external_median_rows is None:
+        external_median_rows = external_median.EXTERNAL_MEDIAN_ROWS
+    spilled = None
+    if isinstance(df, external_median.SpilledMeasurements):
+        spilled = df
+    elif split_dfs is None and len(df) > external_median_rows:
+        print(f'More than {external_median_rows} rows, taking the medians out of core...')
+        spilled = external_median.SpilledMeasurements.from_frame(df)
 
-    # Adjust bounds to ensure they are multiples of cell_size
-    xmin_adj = np.floor(xmin / cell_size) * cell_size
-    xmax_adj = xmin_adj + ncols * cell_size
-    ymin_adj = np.floor(ymin / cell_size) * cell_size
-    ymax_adj = ymin_adj + nrows * cell_size
+    # Define data bounds and grid size
+    if bounds is not None:
+        xmin, ymin, xmax, ymax = bounds
+    elif spilled is not None:
+        xmin, ymin, xmax, ymax = spilled.bounds
+    else:
+        xmin, ymin = df['x'].min(), df['y'].min()
+        xmax, ymax = df['x'].max(), df['y'].max()
 
     # Create the raster grid
-    x_edges = np.linspace(xmin_adj, xmax_adj, ncols + 1)
-    y_edges = np.linspace(ymin_adj, ymax_adj, nrows + 1)
-
+    x_edges, y_edges = binning.grid_edges(xmin, xmax, ymin, ymax, cell_size)
+    xmin_adj, ymax_adj = x_edges[0], y_edges[-1]
 
+    transform = rio.transform.from_origin(xmin_adj, ymax_adj, cell_size, cell_size)
 
-    sum_array = np.zeros((ncols, nrows)) #initialize sum array for adding array values from different network providers
-    count_array = np.zeros((ncols, nrows)) #initialize count array for counting the amount of network providers
-
-    #calculate median mW for each cell and add them to the sum array
-    for df in split_dfs:
-        ############if out of bounds error, probably a geometry issue. Spain had this issue until i removed the far away islands from the geometry
-        statistic, x_edge, y_edge, binnumber = scipy.stats.binned_statistic_2d(
-            df['x'], df['y'], df['LTE_mW_total'], statistic='median', bins=[x_edges, y_edges]
-        )
-        statistic = np.nan_to_num(statistic, nan=0.0) #convert nans to 0 for calculating purposes
-        sum_array += statistic
+    ############if out of bounds error, probably a geometry issue. Spain had this issue until i removed the far away islands from the geometry
+    if spilled is not None:
+        try:
+            cell_ids, sums, counts = spilled.provider_cell_sums(x_edges, y_edges)
+        finally:
+            spilled.cleanup()
+    if sparse:
+        if split_dfs is not None:
+            raise ValueError('sparse exposure arrays require split_dfs=None')
+        if spilled is None:
+            cell_ids, sums, counts = binning.provider_cell_sums(df, x_edges, y_edges)
+        ncols, nrows = len(x_edges) - 1, len(y_edges) - 1
+        sum_grid = binning.SparseGrid.from_cell_ids(cell_ids, 10 * np.log10(sums), ncols, nrows)
+        count_grid = binning.SparseGrid.from_cell_ids(cell_ids, counts, ncols, nrows)
+        return sum_grid, count_grid, transform
+
+    if spilled is not None:
+        sum_array = np.zeros((len(x_edges) - 1) * (len(y_edges) - 1))
+        count_array = np.zeros_like(sum_array)
+        sum_array[cell_ids] = sums
+        count_array[cell_ids] = counts
+        sum_array = sum_array.reshape(len(x_edges) - 1, len(y_edges) - 1)
+        count_array = count_array.reshape(len(x_edges) - 1, len(y_edges) - 1)
+    elif split_dfs is None:
+        sum_array, count_array = binning.binned_provider_sums(df, x_edges, y_edges)
+    else:
+        sum_array = np.zeros((len(x_edges) - 1, len(y_edges) - 1)) #initialize sum array for adding array values from different network providers
+        count_array = np.zeros((len(x_edges) - 1, len(y_edges) - 1)) #initialize count array for counting the amount of network providers
+
+        #calculate median mW for each cell and add them to the sum array
+        for df in split_dfs:
+            statistic, x_edge, y_edge, binnumber = scipy.stats.binned_statistic_2d(
+                df['x'], df['y'], df['LTE_mW_total'], statistic='median', bins=[x_edges, y_edges]
+            )
+            statistic = np.nan_to_num(statistic, nan=0.0) #convert nans to 0 for calculating purposes
+            sum_array += statistic
 
-        non_zero_mask = statistic != 0  #check which cells have valid values
-        count_array += non_zero_mask #add valid values to count array to count network providers
+            non_zero_mask = statistic != 0  #check which cells have valid values
+            count_array += non_zero_mask #add valid values to count array to count network providers
 
     #############
     np.where(sum_array == 0, np.nan,sum_array) #convert 0 back to nan
@@ -172,12 +504,18 @@ def create_exposure_array(df, split_dfs,cell_size):
     sum_array = np.rot90(sum_array, k=1) 
     count_array = np.rot90(count_array, k=1)
 
-    transform = rio.transform.from_origin(xmin_adj, ymax_adj, cell_size, cell_size)
-
     return sum_array, count_array,transform
 
 def map_calibration(exposure_array,calibration_method):
     print('Applying map calibration function...')
+    if isinstance(exposure_array, binning.SparseGrid):
+        #calibrate the stored cells only, cells without data stay nodata
+        return exposure_array.with_values(
+            _calibrate(exposure_array.values, calibration_method)
+        )
+    return _calibrate(exposure_array, calibration_method)
+
+def _calibrate(exposure_array,calibration_method):
     if calibration_method == 'LTE_rssi':
         calibrated_array = 166.21712 + (0.83513 * exposure_array) 
         calibrated_array = 10 ** ((calibrated_array- 120) / 20)
@@ -186,9 +524,163 @@ def map_calibration(exposure_array,calibration_method):
         calibrated_array = 10 ** ((calibrated_array- 120) / 20) #convert dBv/m to V/m
     return calibrated_array
 
+@functools.lru_cache(maxsize=None)
+def _raster_compression():
+    #ZSTD is faster than DEFLATE at a similar ratio, but not in every GDAL build
+    driver = gdal.GetDriverByName('COG')
+    options = (driver.GetMetadataItem('DMD_CREATIONOPTIONLIST') if driver else None) or ''
+    return 'ZSTD' if 'ZSTD' in options else 'DEFLATE'
+
+class RasterStatistics:
+    """
+    Maximum, minimum, mean and standard deviation of a raster, accumulated
+    block by block in one pass. NaN values are ignored.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+
+    def add(self, block):
+        count = np.count_nonzero(~np.isnan(block))
+        if count == 0:
+            return
+        block_mean = np.nansum(block, dtype=np.float64) / count
+        block_m2 = np.nansum(np.square(block - block_mean, dtype=np.float64))
+        #merge mean and sum of squared deviations (Chan et al.)
+        total = self.count + count
+        delta = block_mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += block_m2 + delta**2 * self.count * count / total
+        self.count = total
+        self.minimum = min(self.minimum, float(np.nanmin(block)))
+        self.maximum = max(self.maximum, float(np.nanmax(block)))
+
+    def tags(self):
+        """GDAL statistics tags, empty if no valid value was added."""
+        if self.count == 0:
+            return {}
+        return {
+            'STATISTICS_MAXIMUM': self.maximum,
+            'STATISTICS_MINIMUM': self.minimum,
+            'STATISTICS_MEAN': self.mean,
+            'STATISTICS_STDDEV': np.sqrt(self.m2 / self.count),
+        }
+
+def _tile_windows(height, width, tile_size=RASTER_TILE_SIZE):
+    for row_off in range(0, height, tile_size):
+        for col_off in range(0, width, tile_size):
+            yield row_off, col_off, min(tile_size, height - row_off), min(tile_size, width - col_off)
+
+def _array_tiles(array, tile_size=RASTER_TILE_SIZE):
+    for row_off, col_off, height, width in _tile_windows(*array.shape, tile_size):
+        yield row_off, col_off, array[row_off:row_off + height, col_off:col_off + width]
+
+def write_cog(output_raster_path, height, width, transform, crs, tiles, tile_size=RASTER_TILE_SIZE):
+    """
+    Write float32 tiles as a tiled, compressed (predictor 3) Cloud Optimized
+    GeoTIFF with internal overviews. The tiles are collected in a compressed
+    in-memory GeoTIFF that the COG driver copies to disk, so the output file
+    is written once. Zeros are written as nodata (NaN) and tiles without
+    data are not stored. Statistics are computed while writing.
+
+    Args:
+        tiles (iterable): (row_off, col_off, array) per tile, on the
+        tile_size grid.
+    """
+    profile = {
+        'driver': 'GTiff',
+        'height': height,
+        'width': width,
+        'count': 1,
+        'dtype': 'float32',
+        'crs': crs,
+        'transform': transform,
+        'nodata': np.nan,
+        'tiled': True,
+        'blockxsize': tile_size,
+        'blockysize': tile_size,
+        'sparse_ok': True,
+        'compress': _raster_compression(),
+        'predictor': 3
+    }
+    statistics = RasterStatistics()
+    with rio.MemoryFile() as memfile:
+        with memfile.open(**profile) as dst:
+            for row_off, col_off, tile in tiles:
+                tile = tile.astype('float32')
+                tile[tile == 0] = np.nan #replace all zeros with nans in the array
+                if np.isnan(tile).all():
+                    continue
+                statistics.add(tile)
+                window = rio.windows.Window(col_off, row_off, tile.shape[1], tile.shape[0])
+                dst.write(tile, 1, window=window)
+            tags = statistics.tags()
+            if tags:  # Only update tags if valid data exists
+                dst.update_tags(1, **tags)
+            else:
+                print("Warning: Raster contains only zeros or nans. Check source CRS and transformation.")
+
+        with memfile.open() as src:
+            rio_copy(
+                src, output_raster_path,
+                driver='COG',
+                blocksize=tile_size,
+                compress=_raster_compression(),
+                predictor=3,
+                overview_resampling=RASTER_OVERVIEW_RESAMPLING,
+                sparse_ok=True
+            )
+
+def update_raster_tiles(raster_path, grid, tile_offsets, tile_size=RASTER_TILE_SIZE):
+    """
+    Refresh some tiles of a raster written by save_raster from a
+    binning.SparseGrid with the same grid. Only these tiles are rasterized
+    from the grid, the others are copied from the raster. The raster is
+    rewritten with new overviews and statistics, keeping the COG layout.
+
+    Args:
+        raster_path (str): Existing raster, replaced.
+        grid (binning.SparseGrid): Calibrated grid with the raster's shape.
+        tile_offsets (iterable): (row_off, col_off) of the tiles to write,
+        multiples of tile_size.
+        tile_size (int): Tile size the raster was written with.
+    """
+    tile_offsets = set(tile_offsets)
+    print(f'Updating {len(tile_offsets)} tiles of {raster_path}...')
+    with rio.open(raster_path) as src:
+        if src.shape != grid.shape:
+            raise ValueError('grid does not match the raster to update')
+
+        def tiles():
+            for row_off, col_off, height, width in _tile_windows(grid.height, grid.width, tile_size):
+                if (row_off, col_off) in tile_offsets:
+                    yield row_off, col_off, grid.to_dense(row_off, col_off, height, width, dtype='float32')
+                else:
+                    yield row_off, col_off, src.read(1, window=rio.windows.Window(col_off, row_off, width, height))
+
+        write_cog(raster_path + '.tmp', grid.height, grid.width, src.transform, src.crs, tiles(), tile_size)
+    os.replace(raster_path + '.tmp', raster_path)
+
 def save_raster(output_raster_path, array, transform, source_crs='EPSG:3035',target_crs='EPSG:3035'):
     print('Saving raster...')
 
+    if isinstance(array, binning.SparseGrid):
+        if source_crs != target_crs:
+            raise ValueError('sparse grids can only be saved in their source CRS')
+        write_cog(output_raster_path, array.height, array.width, transform, target_crs,
+                   array.tiles(RASTER_TILE_SIZE, dtype='float32'))
+        print(f"Raster file saved in {target_crs}")
+        return
+
+    if rio.crs.CRS.from_user_input(source_crs) == rio.crs.CRS.from_user_input(target_crs):
+        #same CRS, no reprojection needed
+        write_cog(output_raster_path, array.shape[0], array.shape[1], transform, target_crs, _array_tiles(array))
+        print(f"Raster file saved in {target_crs}")
+        return
+
     #calculate the bounds from the transform
     height, width = array.shape
     left = transform.c
@@ -211,41 +703,26 @@ def save_raster(output_raster_path, array, transform, source_crs='EPSG:3035',tar
         dst_crs=target_crs,
         resampling=Resampling.nearest
     )
-    reprojected_array[reprojected_array == 0] = np.nan #replace all zeros with nans in the array
-    
-    if np.all(reprojected_array == 0) or np.all(np.isnan(reprojected_array)):
-        print("Warning: Reprojected array contains only zeros or nans. Check source CRS and transformation.")
     
     #write reprojected data
-    with rio.open(
-        output_raster_path, 'w',
-        driver='GTiff',
-        height=dst_height,
-        width=dst_width,
-        count=1,
-        dtype='float32',
-        crs=target_crs,
-        transform=dst_transform,
-        nodata=np.nan
-    ) as dst:
-        dst.write(reprojected_array, 1)
-    # Compute statistics, ignoring NaN
-        valid_data = reprojected_array[~np.isnan(reprojected_array)]  # Ignore NaN
-        if valid_data.size > 0:  # Only update tags if valid data exists
-            dst.update_tags(1,
-                        STATISTICS_MAXIMUM=valid_data.max(),
-                        STATISTICS_MINIMUM=valid_data.min(),
-                        STATISTICS_MEAN=valid_data.mean(),
-                        STATISTICS_STDDEV=valid_data.std())
-    
+    write_cog(output_raster_path, dst_height, dst_width, dst_transform, target_crs, _array_tiles(reprojected_array))
     print(f"Raster file saved in {target_crs}")
 
-def add_frequency_colums(measurement_df):
-    print('Adding frequency columns...')
-    #load earfcn to frequency mapping table
-    earfcn_mapping_df = pd.read_csv('data\earfcn_frequency_ranges.csv', delimiter=';')
+@functools.lru_cache(maxsize=None)
+def _earfcn_bands(mapping_path=EARFCN_MAPPING_PATH):
+    """
+    Read the band table as linear EARFCN to frequency mappings.
+
+    Args:
+        mapping_path (str): Path to the ';' separated band table.
+
+    Returns:
+        tuple: (earfcn_low, earfcn_high, slope, intercept) per band, in
+        file order, so that frequency = slope * earfcn + intercept.
+    """
+    earfcn_mapping_df = pd.read_csv(mapping_path, delimiter=';')
 
-    earfcn_to_freq = {}
+    earfcn_bands = []
     for _, row in earfcn_mapping_df.iterrows():
         low_earfcn = row['earfcn_low']
         high_earfcn = row['earfcn_high']
@@ -256,45 +733,115 @@ def add_frequency_colums(measurement_df):
         if low_earfcn != high_earfcn:
             slope = (high_freq - low_freq) / (high_earfcn - low_earfcn)
             intercept = low_freq - slope * low_earfcn
-            for earfcn in range(int(low_earfcn), int(high_earfcn) + 1):
-                freq = slope * earfcn + intercept
-                earfcn_to_freq[earfcn] = freq
         else:
-            earfcn_to_freq[int(low_earfcn)] = low_freq
+            slope = 0.0
+            intercept = low_freq
+        earfcn_bands.append((int(low_earfcn), int(high_earfcn), slope, intercept))
+    return tuple(earfcn_bands)
 
+@functools.lru_cache(maxsize=None)
+def _earfcn_frequency_lookup(mapping_path=EARFCN_MAPPING_PATH):
+    """
+    Build the EARFCN to frequency lookup array from the band table.
 
-    for i in range(10):  #assuming LTE_0 to LTE_9
-        earfcn_col = f'LTE_{i}_earfcn'
-        freq_col = f'LTE_{i}_frequency'
-        measurement_df[freq_col] = measurement_df[earfcn_col].apply(
-            lambda earfcn: round(earfcn_to_freq.get(earfcn, None), 1) if earfcn_to_freq.get(earfcn, None) is not None else None
-        )
+    The array is indexed by EARFCN and holds the frequency in MHz,
+    rounded to one decimal, or NaN for EARFCNs that are not part of
+    any band. It is built once per process and cached.
+
+    Args:
+        mapping_path (str): Path to the ';' separated band table.
+
+    Returns:
+        numpy.ndarray: float64 array of length max(earfcn_high) + 1.
+    """
+    earfcn_bands = _earfcn_bands(mapping_path)
+    lookup = np.full(max(band[1] for band in earfcn_bands) + 1, np.nan)
+
+    #later bands overwrite earlier ones, as the old dict lookup did
+    for low_earfcn, high_earfcn, slope, intercept in earfcn_bands:
+        lookup[low_earfcn:high_earfcn + 1] = [
+            round(slope * earfcn + intercept, 1) for earfcn in range(low_earfcn, high_earfcn + 1)
+        ]
+    lookup.setflags(write=False)
+    return lookup
+
+def earfcn_to_frequency(earfcns):
+    """
+    Map an array of EARFCN values to frequencies in MHz.
+
+    Args:
+        earfcns (numpy.ndarray): EARFCN values of any shape, NaN for 
+        missing values.
+
+    Returns:
+        numpy.ndarray: float64 array of the same shape with the rounded
+        frequency, NaN where the EARFCN is missing or not in any band.
+    """
+    lookup = _earfcn_frequency_lookup()
+    earfcns = np.asarray(earfcns, dtype=np.float64)
+    frequencies = np.full(earfcns.shape, np.nan)
+
+    #only whole, in-range EARFCNs can be found in the lookup
+    valid = (np.isfinite(earfcns) & (earfcns >= 0) & (earfcns < len(lookup))
+             & (earfcns == np.floor(earfcns)))
+    frequencies[valid] = lookup[earfcns[valid].astype(np.int64)]
+    return frequencies
+
+def add_frequency_colums(measurement_df):
+    print('Adding frequency columns...')
+    earfcn_cols = [f'LTE_{i}_earfcn' for i in range(10)]  #assuming LTE_0 to LTE_9
+    freq_cols = [f'LTE_{i}_frequency' for i in range(10)]
+
+    #map all earfcn columns in one pass over a (n_rows x 10) matrix
+    earfcns = measurement_df[earfcn_cols].to_numpy(dtype=np.float64, na_value=np.nan)
+    frequencies = earfcn_to_frequency(earfcns).astype(VALUE_DTYPE)
+    for i, freq_col in enumerate(freq_cols):
+        measurement_df[freq_col] = frequencies[:, i]
     return measurement_df
 
-def normalize_ssi(measurement_df,ssi):
-    print(f'Normalizing {ssi} values...')
+def normalize_ssi_values(ssi_values, frequencies, dtype=np.float64):
+    """
+    Normalize signal strength values to the 1800 MHz reference frequency.
+
+    Computes round(ssi + 20 * log10(f / 1800), 2) element-wise on 
+    matrices of equal shape, e.g. (n_rows x 10).
+
+    Args:
+        ssi_values (numpy.ndarray): Signal strength values in dBm.
+        frequencies (numpy.ndarray): Frequencies in MHz.
+        dtype: Output dtype, float32 halves the memory of the result.
+
+    Returns:
+        numpy.ndarray: Normalized values, NaN where the signal strength or
+        the frequency is missing.
+    """
     F0 = 1800  #reference frequency in MHz
+    ssi_values = np.asarray(ssi_values, dtype=np.float64)
+    frequencies = np.asarray(frequencies, dtype=np.float64)
 
-    #the normalization function
-    def normalize_function(ssi, frequency):
-        if frequency is None or pd.isna(frequency): 
-            return None
-        elif ssi is None:
-            return None
-        return round(ssi + 20 * np.log10(frequency / F0), 2)
+    normalized = np.full(ssi_values.shape, np.nan)
+    valid = ~np.isnan(ssi_values) & ~np.isnan(frequencies)
+    normalized[valid] = np.round(
+        ssi_values[valid] + 20 * np.log10(frequencies[valid] / F0), 2
+    )
+    return normalized.astype(dtype, copy=False)
 
-    #apply normalization function and replace original LTE_x_{ssi} columns
-    for i in range(10):
-        try:
-            ssi_col = f'LTE_{i}_{ssi}'
-            freq_col = f'LTE_{i}_frequency'
-            
-            measurement_df[ssi_col] = measurement_df.apply(
-                lambda row: normalize_function(row[ssi_col], row[freq_col]), axis=1
-            )
-        except:
-            print("can't normalize")
-            exit()
+def normalize_ssi(measurement_df,ssi,dtype=VALUE_DTYPE):
+    print(f'Normalizing {ssi} values...')
+    ssi_cols = [f'LTE_{i}_{ssi}' for i in range(10)]
+    freq_cols = [f'LTE_{i}_frequency' for i in range(10)]
+
+    try:
+        ssi_values = measurement_df[ssi_cols].to_numpy(dtype=np.float64, na_value=np.nan)
+        frequencies = measurement_df[freq_cols].to_numpy(dtype=np.float64, na_value=np.nan)
+    except KeyError:
+        print("can't normalize")
+        exit()
+
+    #replace original LTE_x_{ssi} columns with the normalized values
+    normalized = normalize_ssi_values(ssi_values, frequencies, dtype=dtype)
+    for i, ssi_col in enumerate(ssi_cols):
+        measurement_df[ssi_col] = normalized[:, i]
 
     return measurement_df
 
@@ -313,8 +860,7 @@ def compress_tif(input_folder,output_folder):
     options = [
         "COMPRESS=DEFLATE",
         "TILED=YES",
-        "TILED=YES",
-        "PREDICTOR=2"
+        "PREDICTOR=3"
     ]
 
     input_files = glob.glob(f"{input_folder}/*.tif")
@@ -0,0 +1,214 @@
+"""
+Incremental daily runs. Per (country, ssi) the binning inputs of every
+measurement seen so far (network provider, x, y and LTE_mW_total) are
+kept on disk together with a watermark: the latest measurement ts. A run
+only fetches measurements after the watermark, merges them into the
+stored points, re-bins only the stored points in the raster tiles that
+hold new points and rewrites only these tiles. Countries without new
+measurements keep the previous raster. The raster of the state is kept
+in the state folder and copied to the output folder, so the merge step
+may remove the per ssi outputs; without it the raster is rebuilt from the
+stored points.
+
+The stored points are an exact mergeable structure for the per cell
+medians: merging is a concatenation and the medians are taken over all
+points again, so the grid equals a full recomputation over the same
+measurements. Measurements inserted later with a ts at or before the
+watermark, or deleted measurements, are only picked up by a full run
+(full=True), which rebuilds the state from scratch.
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import rasterio as rio
+
+import binning
+import helper_functions as hf
+
+POINT_COLUMNS = ['x', 'y', 'DIRECT_connection_mcc_mnc', 'LTE_mW_total']
+
+
+def _state_paths(state_folder, country, ssi):
+    base = os.path.join(state_folder, ssi, country)
+    return f'{base}.json', f'{base}.npz', f'{base}.tif'
+
+def load_country_state(state_folder, country, ssi):
+    """
+    Load the stored state of a country.
+
+    Returns:
+        tuple: (state dict, points DataFrame with POINT_COLUMNS), or
+        (None, None) if the country has no state yet.
+    """
+    state_path, points_path, _ = _state_paths(state_folder, country, ssi)
+    if not (os.path.exists(state_path) and os.path.exists(points_path)):
+        return None, None
+
+    with open(state_path) as f:
+        state = json.load(f)
+    with np.load(points_path) as stored:
+        points = pd.DataFrame({
+            'x': stored['x'],
+            'y': stored['y'],
+            'DIRECT_connection_mcc_mnc': stored['providers'][stored['provider_ids']],
+            'LTE_mW_total': stored['mw'],
+        })
+    return state, points
+
+def _save_state(state_path, state):
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(state_path + '.tmp', state_path)
+
+def save_country_state(state_folder, country, ssi, state, points=None):
+    """
+    Store the state and points of a country. Providers are stored as codes
+    in order of first appearance, which keeps the summation order of the
+    grid stable between runs. With points=None only the state is written.
+    """
+    state_path, points_path, _ = _state_paths(state_folder, country, ssi)
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    if points is None:
+        _save_state(state_path, state)
+        return
+
+    provider_ids, providers = pd.factorize(points['DIRECT_connection_mcc_mnc'].astype(str), sort=False)
+    #write to temporary files first, so an interrupted run keeps the old state
+    np.savez(points_path + '.tmp.npz',
+             x=points['x'].to_numpy(dtype=np.float64),
+             y=points['y'].to_numpy(dtype=np.float64),
+             provider_ids=provider_ids.astype(np.int32),
+             providers=np.asarray(providers, dtype=str),
+             mw=points['LTE_mW_total'].to_numpy(dtype=np.float64))
+    os.replace(points_path + '.tmp.npz', points_path)
+    _save_state(state_path, state)
+
+def changed_tiles(points, new_points, cell_size, tile_size=hf.RASTER_TILE_SIZE):
+    """
+    Raster tiles holding at least one of the new points.
+
+    Args:
+        points (DataFrame): All points, defining the grid.
+        new_points (DataFrame): Points added in this run.
+
+    Returns:
+        list: (row_off, col_off) per tile.
+    """
+    x_edges, y_edges = binning.grid_edges(points['x'].min(), points['x'].max(),
+                                          points['y'].min(), points['y'].max(), cell_size)
+    xi = binning.bin_indices(new_points['x'].to_numpy(), x_edges)
+    yi = binning.bin_indices(new_points['y'].to_numpy(), y_edges)
+    inside = (xi >= 0) & (yi >= 0)
+
+    rows = (len(y_edges) - 2 - yi[inside]) // tile_size * tile_size
+    cols = xi[inside] // tile_size * tile_size
+    return sorted(set(zip(rows.tolist(), cols.tolist())))
+
+def changed_tile_grid(points, x_edges, y_edges, tile_offsets, calibration_method, tile_size=hf.RASTER_TILE_SIZE):
+    """
+    Calibrated grid of the cells in some raster tiles, binned from only
+    the points in these tiles. Medians are per cell, so these cells equal
+    a binning of all points. Providers are coded over all points, which
+    keeps their summation order.
+
+    Returns:
+        binning.SparseGrid: The full grid shape, holding only the cells of
+        the tiles.
+    """
+    ncols, nrows = len(x_edges) - 1, len(y_edges) - 1
+    provider_ids, xi, yi, values = binning.cell_indices(points, x_edges, y_edges)
+    tiles_per_row = -(-ncols // tile_size)
+    tile_ids = (nrows - 1 - yi) // tile_size * tiles_per_row + xi // tile_size
+    wanted = [row_off // tile_size * tiles_per_row + col_off // tile_size for row_off, col_off in tile_offsets]
+    selected = np.isin(tile_ids, wanted)
+
+    cell_ids, sums, _ = binning.grouped_cell_sums(
+        provider_ids[selected], xi[selected] * nrows + yi[selected], values[selected]
+    )
+    exposure_grid = binning.SparseGrid.from_cell_ids(cell_ids, 10 * np.log10(sums), ncols, nrows)
+    return hf.map_calibration(exposure_grid, calibration_method)
+
+def _rebuild_raster(points, raster_path, cell_size_output, ssi):
+    exposure_grid, count_grid, transform = hf.create_exposure_array(points, None, cell_size_output, sparse=True)
+    calibrated_grid = hf.map_calibration(exposure_grid, calibration_method=f'LTE_{ssi}')
+    hf.save_raster(raster_path, calibrated_grid, transform, source_crs='EPSG:3035', target_crs='EPSG:3035')
+    return transform, calibrated_grid.shape
+
+def update_country(country, ssi, today, output_folder, cell_size_output, state_folder, full=False):
+    """
+    Bring the raster of a country up to date with the measurements added
+    since the previous run.
+
+    Args:
+        state_folder (str): Folder holding the per country state.
+        full (bool): Ignore the stored state and recompute from all
+        measurements.
+
+    Returns:
+        tuple: (country, number of points in the grid, raster path), like
+        main.process_country.
+    """
+    print(f'Updating {country} {ssi}')
+    tif_output_path = f"{output_folder}/LTE_{ssi}_{country}_{today}.tif"
+    state_raster = _state_paths(state_folder, country, ssi)[2]
+    state, points = (None, None) if full else load_country_state(state_folder, country, ssi)
+    since = state['watermark'] if state else None
+
+    df = hf.fetch_country_data(country, ssi, since=since, optional_columns=('ts',))
+    if df.empty:
+        if state is None:
+            return (country, 0, None)
+        #no new measurements, carry over the previous raster
+        print(f'No new measurements for {country} {ssi}')
+        if not os.path.exists(state_raster):
+            print(f'No stored raster for {country} {ssi}, rebuilding it from the stored points')
+            _rebuild_raster(points, state_raster, cell_size_output, ssi)
+        shutil.copyfile(state_raster, tif_output_path)
+        state['raster'] = tif_output_path
+        save_country_state(state_folder, country, ssi, state)
+        return (country, len(points), tif_output_path)
+
+    #only measurements after the previous watermark were fetched
+    watermark = str(df['ts'].max())
+    df = hf.add_frequency_colums(df)
+    df = hf.normalize_ssi(df, ssi)
+    df_mw = hf.convert_dBm_to_mW(df, ssi)
+    new_points = df_mw[POINT_COLUMNS].copy()
+    del df, df_mw
+
+    if points is not None:
+        points = pd.concat([points, new_points], ignore_index=True)
+    else:
+        points = new_points
+    if points.empty:
+        return (country, 0, None)
+
+    #the grid of all points, it only changes when new points extend the bounds
+    x_edges, y_edges = binning.grid_edges(points['x'].min(), points['x'].max(),
+                                          points['y'].min(), points['y'].max(), cell_size_output)
+    transform = rio.transform.from_origin(x_edges[0], y_edges[-1], cell_size_output, cell_size_output)
+    shape = [len(y_edges) - 1, len(x_edges) - 1]
+
+    same_grid = (state is not None and state['transform'] == list(transform)[:6]
+                 and state['shape'] == shape and os.path.exists(state_raster))
+    if same_grid:
+        tile_offsets = changed_tiles(points, new_points, cell_size_output)
+        calibrated_grid = changed_tile_grid(points, x_edges, y_edges, tile_offsets, f'LTE_{ssi}')
+        hf.update_raster_tiles(state_raster, calibrated_grid, tile_offsets)
+    else:
+        os.makedirs(os.path.dirname(state_raster), exist_ok=True)
+        _rebuild_raster(points, state_raster, cell_size_output, ssi)
+    shutil.copyfile(state_raster, tif_output_path)
+
+    state = {
+        'watermark': watermark,
+        'raster': tif_output_path,
+        'transform': list(transform)[:6],
+        'shape': shape,
+    }
+    save_country_state(state_folder, country, ssi, state, points)
+    return (country, len(points), tif_output_path)
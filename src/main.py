@@ -1,8 +1,17 @@
 import importlib
 import pandas as pd
+import numpy as np
 import helper_functions as hf
+import scheduler
+import incremental
+import merge_rasters
+import profiling
+import tiling
+import pyramid
+import country_borders
+import concurrent.futures
 import csv
-import subprocess
+import functools
 import glob
 import os
 import gc
@@ -13,26 +22,196 @@ import time
 os.environ['PROJ_LIB'] = r'data'
 
 
-def process_country(country, ssi, today, output_folder, cell_size_output):
+def _cell_count(count_array):
+    #cells with data of a dense or sparse (binning.SparseGrid) count array
+    if isinstance(count_array, np.ndarray):
+        return int(np.count_nonzero(count_array))
+    return len(count_array.values)
+
+
+def _country_bounds(country):
+    #the border cache is checked against the database once per run in the parent (country_areas in __main__)
+    bounds = country_borders.country_bounds(country, check=False)
+    if bounds is None:
+        print(f'No cached border for {country}, the grid covers the measurements')
+    return bounds
+
+def _save_pyramid(profile, df_mw, ssi, cell_sizes, tif_output_path, stage_ssi=None, bounds=None):
+    #binning, calibration and raster of every cell size from one assignment of the cells, see pyramid.py
+    levels = pyramid.calibrated_grids(df_mw, cell_sizes, calibration_method=f'LTE_{ssi}', bounds=bounds)
+    for _ in set(cell_sizes):
+        with profile.stage('pyramid_binning', stage_ssi) as stage:
+            cell_size, calibrated_grid, count_grid, transform = next(levels)
+            stage['cell_size'] = cell_size
+            stage['cells'] = _cell_count(count_grid)
+        with profile.stage('save_raster', stage_ssi) as stage:
+            stage['cell_size'] = cell_size
+            raster_path = pyramid.output_path(tif_output_path, cell_size, min(cell_sizes))
+            hf.save_raster(raster_path, calibrated_grid, transform, source_crs='EPSG:3035', target_crs='EPSG:3035')
+
+def _bin_and_save(profile, df_mw, ssi, cell_size_output, tif_output_path, sparse=True, tile_workers=None,
+                  pyramid_cell_sizes=None, stage_ssi=None, bounds=None):
+    #binning, calibration and raster writing of one ssi family, see process_country for the options
+    if pyramid_cell_sizes:
+        _save_pyramid(profile, df_mw, ssi, (cell_size_output, *pyramid_cell_sizes), tif_output_path, stage_ssi,
+                      bounds)
+        return
+    if tile_workers:
+        with profile.stage('tiled_binning', stage_ssi) as stage:
+            calibrated_array, count_array, transform = tiling.calibrated_grid(
+                df_mw, cell_size_output, f'LTE_{ssi}', max_workers=tile_workers, bounds=bounds
+            )
+            stage['cells'] = _cell_count(count_array)
+    else:
+        #split_dfs=None: all network providers are binned in one pass
+        with profile.stage('binning', stage_ssi) as stage:
+            exposure_array, count_array, transform = hf.create_exposure_array(df_mw, None, cell_size_output,
+                                                                              sparse=sparse, bounds=bounds)
+            stage['cells'] = _cell_count(count_array)
+        with profile.stage('calibration', stage_ssi):
+            calibrated_array = hf.map_calibration(exposure_array, calibration_method=f'LTE_{ssi}')
+    with profile.stage('save_raster', stage_ssi):
+        hf.save_raster(tif_output_path, calibrated_array, transform, source_crs='EPSG:3035', target_crs='EPSG:3035')
+
+
+def process_country(country, ssi, today, output_folder, cell_size_output, server_side_mw=False, chunksize=None,
+                    sparse=True, indexed=False, use_cache=False, tile_workers=None, pyramid_cell_sizes=None,
+                    country_grid=False):
+    """
+    Create the calibrated exposure raster of one country.
+
+    With chunksize set, the country is streamed through a server side
+    cursor in chunks of that many rows instead of being fetched at once.
+    With sparse set, only cells with measurements are kept in memory and
+    the raster is written tile by tile. With indexed set, the country
+    filter uses the subdivided border table (see sql_queries._country_filter).
+    With use_cache set, the normalized frame is read from the local frame
+    cache while the database has no new measurements (see frame_cache).
+    With tile_workers set, binning and calibration run as parallel tiles
+    in a pool of that many processes (see tiling), for the largest
+    countries. With pyramid_cell_sizes set, e.g. (100, 500), rasters at
+    these coarser cell sizes are written as well, from the same fetch and
+    cell assignment (see pyramid), instead of the tiled binning. With
+    country_grid set, the grid is laid out over the cached bounding box of
+    the country (see country_borders) instead of the data bounds, so the
+    rasters of a country keep one extent from run to run and for every ssi
+    family, and far away outliers are dropped while binning. Use it with
+    sparse, the dense arrays cover the whole bounding box.
+    """
     print(f'Processing {country} {ssi}')
     output_name = f'LTE_{ssi}_{country}_{today}'
     csv_output_path = f"{output_folder}/{output_name}.csv"
     tif_output_path = f"{output_folder}/{output_name}.tif"
 
-    df = hf.fetch_country_data(country, ssi)
-    if df.empty:
-        return (country, 0, None)
+    with profiling.profile_job(country, ssi) as profile:
+        if chunksize:
+            with profile.stage('fetch_chunked') as stage:
+                accumulator, meas_count = hf.fetch_country_mw_chunked(
+                    country, ssi, chunksize=chunksize, server_side_mw=server_side_mw, indexed=indexed
+                )
+                stage['rows'] = meas_count
+            if accumulator.row_count == 0:
+                return (country, 0, None)
+            df_mw = accumulator.to_frame()
+        elif use_cache and not server_side_mw:
+            with profile.stage('fetch_normalized') as stage:
+                df = hf.fetch_normalized_country_data(country, ssi, indexed=indexed)
+                stage['rows'] = len(df)
+                stage['fetched_bytes'] = profiling.frame_bytes(df)
+            if df.empty:
+                return (country, 0, None)
+            meas_count = len(df)
+            with profile.stage('convert_mw') as stage:
+                df_mw = hf.convert_dBm_to_mW(df, ssi, save_csv=False)
+                stage['rows'] = len(df_mw)
+        else:
+            with profile.stage('fetch') as stage:
+                df = hf.fetch_country_data(country, ssi, server_side_mw=server_side_mw, indexed=indexed)
+                stage['rows'] = len(df)
+                stage['fetched_bytes'] = profiling.frame_bytes(df)
+            if df.empty:
+                return (country, 0, None)
+            meas_count = len(df)
+
+            if server_side_mw:
+                #frequency mapping, normalization and mW sum already done in PostgreSQL
+                df_mw = df
+            else:
+                with profile.stage('frequency_mapping'):
+                    df = hf.add_frequency_colums(df)
+                with profile.stage('normalize'):
+                    df = hf.normalize_ssi(df, ssi)
+                with profile.stage('convert_mw') as stage:
+                    df_mw = hf.convert_dBm_to_mW(df, ssi, save_csv=False)
+                    stage['rows'] = len(df_mw)
+
+        bounds = _country_bounds(country) if country_grid else None
+        _bin_and_save(profile, df_mw, ssi, cell_size_output, tif_output_path, sparse, tile_workers, pyramid_cell_sizes,
+                      bounds=bounds)
+
+    return (country, meas_count, tif_output_path)
+
+
+def process_country_combined(country, ssi_values, today, output_folders, cell_size_output, sparse=True,
+                             indexed=False, tile_workers=None, pyramid_cell_sizes=None, country_grid=False):
+    """
+    Create the calibrated exposure rasters of one country for several ssi
+    families from a single fetch. The earfcn frequency columns are mapped
+    once and every family is binned from the same frame.
+
+    Args:
+        ssi_values (tuple): e.g. ('rssi', 'rsrp').
+        output_folders (dict): Output folder per ssi.
+        tile_workers (int): Bin and calibrate as parallel tiles, see
+        process_country.
+        pyramid_cell_sizes (tuple): Coarser cell sizes to write as well,
+        see process_country.
+        country_grid (bool): Grid over the bounding box of the country, see
+        process_country.
+
+    Returns:
+        list: (country, meas_count, raster_path) per ssi, in the order of
+        ssi_values.
+    """
+    print(f'Processing {country} {", ".join(ssi_values)}')
+    with profiling.profile_job(country, tuple(ssi_values)) as profile:
+        with profile.stage('fetch') as stage:
+            df = hf.fetch_country_data_combined(country, ssi_values, indexed=indexed)
+            stage['rows'] = len(df)
+            stage['fetched_bytes'] = profiling.frame_bytes(df)
+        if df.empty:
+            return [(country, 0, None) for ssi in ssi_values]
 
-    df = hf.add_frequency_colums(df)
-    df = hf.normalize_ssi(df, ssi)
-    df_mw = hf.convert_dBm_to_mW(df, ssi, copy_columns=True, save_csv=False)
-    split_dfs = hf.split_dataframes(df_mw)
+        #rows of each family as country_data would return them, before normalization adds NaNs
+        ssi_masks = {ssi: df[f'LTE_0_{ssi}'].notna() for ssi in ssi_values}
 
-    exposure_array, count_array, transform = hf.create_exposure_array(df_mw, split_dfs, cell_size_output)
-    calibrated_array = hf.map_calibration(exposure_array, calibration_method=f'LTE_{ssi}')
-    hf.save_raster(tif_output_path, calibrated_array, transform, source_crs='EPSG:3035', target_crs='EPSG:3035')
+        with profile.stage('frequency_mapping'):
+            df = hf.add_frequency_colums(df)
+        bounds = _country_bounds(country) if country_grid else None
+        results = []
+        for ssi in ssi_values:
+            meas_count = int(ssi_masks[ssi].sum())
+            if meas_count == 0:
+                results.append((country, 0, None))
+                continue
 
-    return (country, len(df), tif_output_path)
+            ssi_columns = [f'LTE_{i}_{ssi}' for i in range(10)]
+            frequency_columns = [f'LTE_{i}_frequency' for i in range(10)]
+            with profile.stage('normalize', ssi) as stage:
+                df_ssi = df.loc[ssi_masks[ssi], ['x', 'y', 'DIRECT_connection_mcc_mnc'] + ssi_columns + frequency_columns]
+                df_ssi = hf.normalize_ssi(df_ssi, ssi)
+                stage['rows'] = meas_count
+            with profile.stage('convert_mw', ssi) as stage:
+                df_mw = hf.convert_dBm_to_mW(df_ssi, ssi, copy_columns=False, save_csv=False)
+                stage['rows'] = len(df_mw)
+            del df_ssi
+
+            tif_output_path = f"{output_folders[ssi]}/LTE_{ssi}_{country}_{today}.tif"
+            _bin_and_save(profile, df_mw, ssi, cell_size_output, tif_output_path, sparse, tile_workers,
+                          pyramid_cell_sizes, stage_ssi=ssi, bounds=bounds)
+            results.append((country, meas_count, tif_output_path))
+
+    return results
 
 
 if __name__ == '__main__':
@@ -56,23 +235,104 @@ if __name__ == '__main__':
                  'SI','SK','SM','UK','UA',
                  'VA','XK']
 
+    output_root = "C:/scripts/ETAIN_mapping_tools/data/private/output"
+    max_workers = os.cpu_count()
+    memory_budget = 64 * 1024**3  #bytes shared by all running countries
+
     meas_per_country = {}
     saved_rasters = []
 
+    #fetch every country once for all ssi families instead of once per family
+    combined_fetch = True
+
+    jobs = []
+    output_folders = {}
     for ssi in ssi_values:
-        output_folder = f"C:/scripts/ETAIN_mapping_tools/data/private/output/{today}/{ssi}"
-        os.makedirs(output_folder, exist_ok=True)
+        output_folders[ssi] = f"{output_root}/{today}/{ssi}"
+        os.makedirs(output_folders[ssi], exist_ok=True)
+    #stage timings and memory per country, see profiling.py
+    profile_run = True
+    if profile_run:
+        profiling.enable(f"{output_root}/{today}/profile", cprofile=False, trace_memory=False)
 
-        for country in countries:
-                country_code, meas_count, raster_path = process_country(
-                    country, ssi, today, output_folder, cell_size_output
-                )
-                if meas_count > 0:
-                    meas_per_country[country_code] = meas_count
-                    saved_rasters.append(raster_path)
-                    print(f'{country_code} processed: {meas_count} measurements')
-                else:
-                    print(f'{country_code} skipped: no measurements found')
+    #only fetch measurements added since the previous run, see incremental.py
+    incremental_run = False
+    state_folder = f"{output_root}/incremental_state"
+
+    if incremental_run:
+        jobs += [(country, ssi, today, output_folders[ssi], cell_size_output, state_folder)
+                 for ssi in ssi_values for country in countries]
+        job_function = incremental.update_country
+    elif combined_fetch:
+        jobs += [(country, tuple(ssi_values), today, output_folders, cell_size_output) for country in countries]
+        job_function = process_country_combined
+    else:
+        jobs += [(country, ssi, today, output_folders[ssi], cell_size_output)
+                 for ssi in ssi_values for country in countries]
+        job_function = process_country
+
+    #mW sums computed in PostgreSQL, see sql_queries.country_data_mw (not with combined_fetch)
+    server_side_mw = False
+    if server_side_mw and job_function is process_country:
+        #filled once here from the band table, the workers only check it
+        hf.ensure_earfcn_frequency(refresh=True)
+        job_function = functools.partial(job_function, server_side_mw=True)
+
+    #index friendly country filter, see sql_queries._country_filter
+    indexed_filter = False
+    if indexed_filter and not incremental_run:
+        #created once here, the workers only check that it exists
+        hf.ensure_subdivided_borders()
+        job_function = functools.partial(job_function, indexed=True)
+
+    #coarser rasters from the same fetch, e.g. (100, 500), written to {cell size}m subfolders, see pyramid.py
+    pyramid_cell_sizes = None
+    if pyramid_cell_sizes and not incremental_run:
+        job_function = functools.partial(job_function, pyramid_cell_sizes=pyramid_cell_sizes)
+
+    #grids over the cached bounding box of every country, see country_borders.py
+    country_grids = True
+    if country_grids and not incremental_run:
+        job_function = functools.partial(job_function, country_grid=True)
+
+    #the largest countries run one at a time, as parallel tiles on part of the cores, see tiling.py
+    tiled_countries = [] if incremental_run or pyramid_cell_sizes else ['FR', 'DE', 'NO']
+    tiled_jobs = [job for job in jobs if job[0] in tiled_countries]
+    jobs = [job for job in jobs if job[0] not in tiled_countries]
+
+    #largest countries first, based on the measurement counts of the previous run
+    #countries without counts are estimated from their area, see country_borders.py
+    previous_counts = scheduler.load_previous_meas_counts(output_root, today)
+    areas = country_borders.country_areas()
+
+    #the tiled countries run next to the pool, on cores and memory reserved for their tile pool
+    tile_workers = max(1, max_workers // 2) if tiled_jobs else 0
+    tiled_bytes = max((scheduler.estimate_job_bytes(job[0], job[1], previous_counts, areas=areas)
+                       for job in tiled_jobs), default=0)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as tiled_runner:
+        tiled_run = tiled_runner.submit(
+            scheduler.run_country_jobs, functools.partial(job_function, tile_workers=tile_workers), tiled_jobs,
+            previous_counts, max_workers=1, areas=areas
+        )
+        results, failures = scheduler.run_country_jobs(
+            job_function, jobs, previous_counts, max_workers=max(1, max_workers - tile_workers),
+            memory_budget=max(memory_budget - tiled_bytes, 0), areas=areas
+        )
+        tiled_results, tiled_failures = tiled_run.result()
+    results += tiled_results
+    failures += tiled_failures
+
+    for ssi, country_code, meas_count, raster_path in results:
+        meas_per_country.setdefault(ssi, {})[country_code] = meas_count
+        if meas_count > 0:
+            saved_rasters.append(raster_path)
+            print(f'{country_code} {ssi} processed: {meas_count} measurements')
+        else:
+            print(f'{country_code} {ssi} skipped: no measurements found')
+    for ssi, country, error in failures:
+        print(f'{country} {ssi} failed: {error}')
+
+    scheduler.save_meas_counts(f"{output_root}/{today}", meas_per_country)
 
 
     """
@@ -83,44 +343,21 @@ if __name__ == '__main__':
     output_folder = f"{folder_path}/lte_eu_mosaic"
     os.makedirs(output_folder, exist_ok=True)
     """
-    def get_country_code(filename):
-        match = re.search(r'_([A-Z]{2})_', filename)
-        return match.group(1) if match else None
-
-    #list TIFFs in each folder
-    rssi_files = {get_country_code(f): os.path.join(rssi_folder, f)
-                for f in os.listdir(rssi_folder) if f.endswith('.tif')}
-    rsrp_files = {get_country_code(f): os.path.join(rsrp_folder, f)
-                for f in os.listdir(rsrp_folder) if f.endswith('.tif')}
-    common_countries = rssi_files.keys() & rsrp_files.keys()
-
-    #merge pairs
-    for country in common_countries:
-        print(f"merging {country}")
-        rssi_path = rssi_files[country]
-        rsrp_path = rsrp_files[country]
-        output_path = os.path.join(output_folder, f"LTE_merged_{country}_{today}.tif")
-
-        gdal.Warp(
-            destNameOrDestDS=output_path,
-            srcDSOrSrcDSTab=[rsrp_path, rssi_path],
-            dstSRS="EPSG:3035",
-            format="GTiff",
-            multithread=True,
-            warpOptions=["COMPRESS=DEFLATE"]
-        )
-        #remove rssi/rsrp input (not needed after merge)
-        os.remove(rssi_path)
-        os.remove(rsrp_path)
+    #merge pairs window by window, in parallel, see merge_rasters.py
+    merged_rasters, merge_failures = merge_rasters.merge_country_pairs(
+        rssi_folder, rsrp_folder, output_folder, today, max_workers=os.cpu_count()
+    )
+    for country, error in merge_failures:
+        print(f'{country} merge failed: {error}')
 
     """
-    #create mosaic shp with gdal subprocess
-    tif_files = glob.glob(f"{output_folder}/*.tif")
+    #create mosaic vrt and tile index shp
+    tif_files = sorted(glob.glob(f"{output_folder}/*.tif"))
     os.environ['GTIFF_SRS_SOURCE'] = 'EPSG'
-    command = ["gdaltindex","-nodata","nan", f"{output_folder}/lte_eu_mosaic.shp"] + tif_files
-    subprocess.run(command)
-    result = subprocess.run(command, capture_output=True, text=True)
+    merge_rasters.build_mosaic(tif_files, output_folder)
 
 
     hf.fetch_metadata(folder_path,today)
+    if os.environ.get(profiling.PROFILE_DIR_ENV):
+        profiling.write_run_report(os.environ[profiling.PROFILE_DIR_ENV], folder_path)
 
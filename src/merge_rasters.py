@@ -0,0 +1,151 @@
+"""
+Merges the rssi and rsrp rasters of each country into one LTE raster and
+builds the EU mosaic (VRT) and its tile index shapefile.
+
+The pair of a country is merged window by window on the union of both
+grids: rssi values take priority and rsrp fills the cells without rssi
+values, like the earlier gdal.Warp of [rsrp, rssi]. Only one tile of each
+input is in memory at a time, and pairs are merged in parallel.
+"""
+
+import concurrent.futures
+import os
+import re
+import traceback
+
+import geopandas as gpd
+import numpy as np
+import rasterio as rio
+from osgeo import gdal
+from shapely.geometry import box
+
+import helper_functions as hf
+
+MOSAIC_NAME = 'lte_eu_mosaic'
+
+
+def get_country_code(filename):
+    match = re.search(r'_([A-Z]{2})_', filename)
+    return match.group(1) if match else None
+
+def pair_country_rasters(rssi_folder, rsrp_folder):
+    """
+    Pair the rssi and rsrp rasters of the same country.
+
+    Returns:
+        dict: {country: (rsrp_path, rssi_path)} for the countries with
+        both rasters.
+    """
+    #list TIFFs in each folder
+    rssi_files = {get_country_code(f): os.path.join(rssi_folder, f)
+                  for f in os.listdir(rssi_folder) if f.endswith('.tif')}
+    rsrp_files = {get_country_code(f): os.path.join(rsrp_folder, f)
+                  for f in os.listdir(rsrp_folder) if f.endswith('.tif')}
+    common_countries = sorted(rssi_files.keys() & rsrp_files.keys())
+    return {country: (rsrp_files[country], rssi_files[country]) for country in common_countries}
+
+def merge_rasters(source_paths, output_path, tile_size=hf.RASTER_TILE_SIZE):
+    """
+    Merge rasters on the same cell grid (same CRS, cell size and aligned
+    origins) into one raster covering all of them. Later sources overwrite
+    earlier ones where they have data.
+
+    Args:
+        source_paths (list): Rasters in increasing priority.
+        output_path (str): Merged raster, written with hf.write_cog.
+    """
+    sources = [rio.open(path) for path in source_paths]
+    try:
+        crs = sources[0].crs
+        res = sources[0].res
+        if any(src.crs != crs or src.res != res for src in sources):
+            raise ValueError(f'rasters are not on the same grid: {source_paths}')
+
+        left = min(src.bounds.left for src in sources)
+        right = max(src.bounds.right for src in sources)
+        bottom = min(src.bounds.bottom for src in sources)
+        top = max(src.bounds.top for src in sources)
+        width = int(round((right - left) / res[0]))
+        height = int(round((top - bottom) / res[1]))
+        transform = rio.transform.from_origin(left, top, res[0], res[1])
+
+        #offset of each source in the merged grid
+        offsets = [(int(round((top - src.bounds.top) / res[1])), int(round((src.bounds.left - left) / res[0])))
+                   for src in sources]
+
+        def tiles():
+            for row_off, col_off, tile_height, tile_width in hf._tile_windows(height, width, tile_size):
+                tile = np.full((tile_height, tile_width), np.nan, dtype='float32')
+                for src, (src_row, src_col) in zip(sources, offsets):
+                    window = rio.windows.Window(col_off - src_col, row_off - src_row, tile_width, tile_height)
+                    block = src.read(1, window=window, boundless=True, fill_value=np.nan)
+                    valid = ~np.isnan(block)
+                    tile[valid] = block[valid]
+                yield row_off, col_off, tile
+
+        hf.write_cog(output_path, height, width, transform, crs, tiles(), tile_size)
+    finally:
+        for src in sources:
+            src.close()
+
+def _merge_country(country, source_paths, output_path, remove_inputs):
+    print(f"merging {country}")
+    merge_rasters(source_paths, output_path)
+    if remove_inputs:
+        #remove rssi/rsrp input (not needed after merge)
+        for path in source_paths:
+            os.remove(path)
+    return output_path
+
+def merge_country_pairs(rssi_folder, rsrp_folder, output_folder, today, max_workers=None, remove_inputs=True):
+    """
+    Merge the rssi and rsrp raster of every country on a process pool.
+
+    Returns:
+        tuple: (merged raster paths, failures as (country, error message)).
+    """
+    pairs = pair_country_rasters(rssi_folder, rsrp_folder)
+    merged = []
+    failures = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(_merge_country, country, source_paths,
+                        os.path.join(output_folder, f"LTE_merged_{country}_{today}.tif"), remove_inputs): country
+            for country, source_paths in pairs.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            country = futures[future]
+            try:
+                merged.append(future.result())
+            except Exception as e:
+                print(f'{country} merge failed:')
+                traceback.print_exc()
+                failures.append((country, repr(e)))
+    return sorted(merged), failures
+
+def build_mosaic(raster_paths, output_folder, name=MOSAIC_NAME):
+    """
+    Build the VRT mosaic and the tile index shapefile of the merged rasters
+    (one polygon per raster, with its path in the 'location' field like
+    gdaltindex).
+
+    Returns:
+        tuple: (vrt path, tile index path)
+    """
+    vrt_path = os.path.join(output_folder, f'{name}.vrt')
+    index_path = os.path.join(output_folder, f'{name}.shp')
+
+    vrt = gdal.BuildVRT(vrt_path, raster_paths, srcNodata='nan', VRTNodata='nan')
+    vrt = None  #flush to disk
+
+    locations = []
+    footprints = []
+    crs = None
+    for path in raster_paths:
+        with rio.open(path) as src:
+            locations.append(path)
+            footprints.append(box(*src.bounds))
+            crs = crs or src.crs
+    tile_index = gpd.GeoDataFrame({'location': locations}, geometry=footprints, crs=crs)
+    tile_index.to_file(index_path)
+    return vrt_path, index_path
@@ -0,0 +1,211 @@
+"""
+Stage level profiling of the country jobs. When enabled, every stage of
+a job (fetch, frequency mapping, normalization, mW conversion, binning,
+calibration, raster writing) records its wall and CPU time, RSS change,
+peak RSS since the start of the job and optionally the tracemalloc peak,
+plus row and cell counts. The fetch stages record the in-memory size of
+the fetched frame (see frame_bytes), as the process I/O counters do not
+count socket reads.
+Each job writes its records to a JSON file in the profile folder, and
+write_run_report collects them into one CSV and JSON report per run.
+An opt-in cProfile dump is written per job as well.
+
+Profiling is configured through environment variables, so jobs running
+in worker processes pick it up (also with the spawn start method).
+Memory figures need psutil, or /proc and the resource module on Linux,
+and are left empty otherwise. Pool workers are reused across jobs, so
+the peak RSS of the process is reset at the start of every job on Linux
+(/proc/self/clear_refs). Where it cannot be reset, the peak is only
+recorded for the first job of a process.
+"""
+
+import cProfile
+import contextlib
+import glob
+import json
+import os
+import time
+import tracemalloc
+
+import pandas as pd
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PROFILE_DIR_ENV = 'ETAIN_PROFILE_DIR'
+CPROFILE_ENV = 'ETAIN_CPROFILE'
+TRACEMALLOC_ENV = 'ETAIN_TRACEMALLOC'
+REPORT_NAME = 'profile_report'
+
+#jobs profiled in this process
+_jobs_profiled = 0
+
+
+def enable(profile_folder, cprofile=False, trace_memory=False):
+    """
+    Enable profiling for this process and the worker processes started
+    after this call.
+
+    Args:
+        profile_folder (str): Folder for the per job records and dumps.
+        cprofile (bool): Also dump a cProfile of every job.
+        trace_memory (bool): Record tracemalloc peaks per stage. Slows
+        down allocation heavy stages.
+    """
+    os.makedirs(profile_folder, exist_ok=True)
+    os.environ[PROFILE_DIR_ENV] = profile_folder
+    os.environ[CPROFILE_ENV] = '1' if cprofile else ''
+    os.environ[TRACEMALLOC_ENV] = '1' if trace_memory else ''
+
+def _rss():
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return None
+
+def _reset_peak_rss():
+    #resets VmHWM in /proc/self/status, not the ru_maxrss of getrusage
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def _peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            return int(next(line for line in f if line.startswith('VmHWM')).split()[1]) * 1024
+    except (OSError, StopIteration):
+        pass
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  #kilobytes on Linux
+    if psutil is not None:
+        return getattr(psutil.Process().memory_info(), 'peak_wset', None)  #Windows
+    return None
+
+def frame_bytes(df):
+    """In-memory size of a fetched DataFrame in bytes, strings included."""
+    return int(df.memory_usage(deep=True).sum())
+
+def _delta(end, start):
+    return None if end is None or start is None else end - start
+
+class JobProfile:
+    """Stage records of one country job."""
+
+    def __init__(self, country, ssi, trace_memory=False, peak_rss=True):
+        self.country = country
+        self.ssi = ssi
+        self.trace_memory = trace_memory
+        #False when the peak RSS of the process includes earlier jobs
+        self.peak_rss = peak_rss
+        self.records = []
+        #traced peaks of the open stages, nested stages reset the tracemalloc peak
+        self._traced_peaks = []
+
+    @contextlib.contextmanager
+    def stage(self, name, ssi=None):
+        """
+        Measure a stage. Yields the record dict of the stage, so counts
+        can be added, e.g. record['rows'] = len(df). ssi overrides the ssi
+        of the job, for jobs processing several ssi families.
+        """
+        record = {'country': self.country, 'ssi': ssi or self.ssi, 'stage': name}
+        if self.trace_memory:
+            if self._traced_peaks:
+                self._traced_peaks[-1] = max(self._traced_peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            traced_start = tracemalloc.get_traced_memory()[0]
+            self._traced_peaks.append(traced_start)
+        rss_start = _rss()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall_s'] = time.perf_counter() - wall_start
+            record['cpu_s'] = time.process_time() - cpu_start
+            record['rss_delta_bytes'] = _delta(_rss(), rss_start)
+            record['peak_rss_bytes'] = _peak_rss() if self.peak_rss else None
+            if self.trace_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, self._traced_peaks.pop())
+                record['traced_delta_bytes'] = current - traced_start
+                record['traced_peak_bytes'] = peak - traced_start
+                if self._traced_peaks:
+                    self._traced_peaks[-1] = max(self._traced_peaks[-1], peak)
+            self.records.append(record)
+
+class _NoProfile:
+    @contextlib.contextmanager
+    def stage(self, name, ssi=None):
+        yield {}
+
+@contextlib.contextmanager
+def profile_job(country, ssi):
+    """
+    Profile one country job, if profiling is enabled (see enable).
+
+    Yields:
+        JobProfile, or a stand-in with the same stage() interface that
+        records nothing when profiling is disabled.
+    """
+    profile_folder = os.environ.get(PROFILE_DIR_ENV)
+    if not profile_folder:
+        yield _NoProfile()
+        return
+
+    ssi = '_'.join(ssi) if isinstance(ssi, (tuple, list)) else ssi
+    job_name = f'{country}_{ssi}'
+    trace_memory = bool(os.environ.get(TRACEMALLOC_ENV))
+    profiler = cProfile.Profile() if os.environ.get(CPROFILE_ENV) else None
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+
+    global _jobs_profiled
+    peak_rss = _reset_peak_rss() or _jobs_profiled == 0
+    _jobs_profiled += 1
+
+    profile = JobProfile(country, ssi, trace_memory, peak_rss)
+    if profiler is not None:
+        profiler.enable()
+    try:
+        with profile.stage('total'):
+            yield profile
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(profile_folder, f'{job_name}.prof'))
+        if started_tracing:
+            tracemalloc.stop()
+        with open(os.path.join(profile_folder, f'{job_name}.json'), 'w') as f:
+            json.dump(profile.records, f, indent=2, default=str)
+
+def write_run_report(profile_folder, output_folder):
+    """
+    Collect the job records of a run into profile_report.csv and
+    profile_report.json in output_folder (next to metadata.gpkg).
+
+    Returns:
+        pandas.DataFrame: One row per job and stage.
+    """
+    records = []
+    for path in sorted(glob.glob(os.path.join(profile_folder, '*.json'))):
+        with open(path) as f:
+            records.extend(json.load(f))
+    report = pd.DataFrame(records)
+    report.to_csv(os.path.join(output_folder, f'{REPORT_NAME}.csv'), sep=';', index=False)
+    with open(os.path.join(output_folder, f'{REPORT_NAME}.json'), 'w') as f:
+        json.dump(records, f, indent=2, default=str)
+    return report
@@ -0,0 +1,135 @@
+"""
+Calibrated rasters at several resolutions from one fetch and one binning
+pass, e.g. the published 25 m raster plus 100 m and 500 m products for
+web viewers and reports.
+
+The providers are coded once, and the measurements are assigned to the
+cells of a fine grid covering all levels once. Every coarser cell size
+must be a multiple of the finest one, and as the grids of
+binning.grid_edges are aligned to multiples of the cell size, every
+coarse cell is made of whole fine cells. The fine cell indices are mapped
+to coarse ones with integer arithmetic, and points on the last edge of a
+level go to its last cell, as in binning.bin_indices. The medians are
+taken again from the underlying values, not from the fine medians. The
+base level is binned on its own grid, so it equals binning the
+measurements at that cell size directly; the coarser levels do too, up to
+points within floating point rounding of an inner cell edge.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import rasterio as rio
+
+import binning
+import external_median
+import helper_functions as hf
+
+
+def coarse_indices(indices, edges, coarse_edges, cell_size, coarse_cell_size):
+    """
+    Bin indices on a coarser grid whose edges are a subset of edges.
+
+    Args:
+        indices (numpy.ndarray): Bin indices on the fine grid, -1 outside.
+        edges, coarse_edges (numpy.ndarray): Fine and coarse grid edges
+        along one axis, see binning.grid_edges.
+        cell_size, coarse_cell_size: Fine and coarse cell size, the
+        coarse one a multiple of the fine one.
+
+    Returns:
+        numpy.ndarray: Coarse bin index per value, -1 outside the grid.
+    """
+    offset = int(round((edges[0] - coarse_edges[0]) / cell_size))
+    coarse = (indices + offset) // (coarse_cell_size // cell_size)
+    coarse[(indices < 0) | (coarse < 0) | (coarse >= len(coarse_edges) - 1)] = -1
+    return coarse
+
+def _last_edge_points(indices, values, edges):
+    #points on the last edge belong to the last bin, as in binning.bin_indices
+    outside = np.flatnonzero((indices < 0) & (values >= edges[-2]))
+    on_edge = binning.bin_indices(values[outside], edges[-2:]) == 0
+    indices[outside[on_edge]] = len(edges) - 2
+    return indices
+
+def _covering_edges(start, end, cell_size):
+    ncells = int(round((end - start) / cell_size))
+    return np.linspace(start, start + ncells * cell_size, ncells + 1)
+
+def calibrated_grids(df, cell_sizes, calibration_method, bounds=None):
+    """
+    Binned and calibrated grids of the measurements at several cell sizes,
+    like create_exposure_array(sparse=True) and map_calibration at every
+    cell size.
+
+    Args:
+        df (DataFrame): Output of convert_dBm_to_mW.
+        cell_sizes (iterable): Cell sizes in CRS units, all multiples of
+        the smallest one.
+        calibration_method (str): 'LTE_rssi' or 'LTE_rsrp'.
+        bounds (tuple): Grid bounds instead of the data bounds, see
+        create_exposure_array.
+
+    Yields:
+        tuple: (cell_size, calibrated, counts, transform) per cell size,
+        from fine to coarse, calibrated and counts as binning.SparseGrid.
+    """
+    if isinstance(df, external_median.SpilledMeasurements):
+        raise ValueError('raster pyramids need the measurements in memory')
+    cell_sizes = sorted(set(cell_sizes))
+    base_size = cell_sizes[0]
+    for cell_size in cell_sizes:
+        if cell_size % base_size:
+            raise ValueError(f'cell size {cell_size} is not a multiple of {base_size}')
+
+    xmin, ymin, xmax, ymax = bounds if bounds is not None else (df['x'].min(), df['y'].min(),
+                                                                df['x'].max(), df['y'].max())
+    grids = {cell_size: binning.grid_edges(xmin, xmax, ymin, ymax, cell_size) for cell_size in cell_sizes}
+    #providers in order of first appearance, like binning.cell_indices
+    provider_ids, _ = pd.factorize(df['DIRECT_connection_mcc_mnc'], sort=False)
+    provider_ids = provider_ids.astype(np.int64)
+    x = df['x'].to_numpy(dtype=np.float64)
+    y = df['y'].to_numpy(dtype=np.float64)
+    values = df['LTE_mW_total'].to_numpy(dtype=np.float64)
+
+    #the fine grid mapped to the coarser levels has to cover the grids of all cell sizes
+    x_edges = _covering_edges(grids[base_size][0][0], max(edges[0][-1] for edges in grids.values()), base_size)
+    y_edges = _covering_edges(grids[base_size][1][0], max(edges[1][-1] for edges in grids.values()), base_size)
+    xi = binning.bin_indices(x, x_edges)
+    yi = binning.bin_indices(y, y_edges)
+
+    for cell_size in cell_sizes:
+        print(f'Binning at {cell_size}...')
+        coarse_x_edges, coarse_y_edges = grids[cell_size]
+        ncols, nrows = len(coarse_x_edges) - 1, len(coarse_y_edges) - 1
+        if cell_size == base_size:
+            cxi = binning.bin_indices(x, coarse_x_edges)
+            cyi = binning.bin_indices(y, coarse_y_edges)
+        else:
+            cxi = _last_edge_points(coarse_indices(xi, x_edges, coarse_x_edges, base_size, cell_size),
+                                    x, coarse_x_edges)
+            cyi = _last_edge_points(coarse_indices(yi, y_edges, coarse_y_edges, base_size, cell_size),
+                                    y, coarse_y_edges)
+        inside = (cxi >= 0) & (cyi >= 0) & (provider_ids >= 0)
+
+        cell_ids, sums, counts = binning.grouped_cell_sums(
+            provider_ids[inside], cxi[inside] * nrows + cyi[inside], values[inside]
+        )
+        exposure_grid = binning.SparseGrid.from_cell_ids(cell_ids, 10 * np.log10(sums), ncols, nrows)
+        count_grid = binning.SparseGrid.from_cell_ids(cell_ids, counts, ncols, nrows)
+        transform = rio.transform.from_origin(coarse_x_edges[0], coarse_y_edges[-1], cell_size, cell_size)
+        yield cell_size, hf.map_calibration(exposure_grid, calibration_method), count_grid, transform
+
+def output_path(tif_output_path, cell_size, base_cell_size):
+    """
+    Raster path of one resolution. The base resolution keeps
+    tif_output_path, coarser ones go to a {cell_size}m subfolder, so they
+    stay out of the merge and mosaic of the base rasters.
+    """
+    if cell_size == base_cell_size:
+        return tif_output_path
+    folder, name = os.path.split(tif_output_path)
+    stem, extension = os.path.splitext(name)
+    os.makedirs(os.path.join(folder, f'{cell_size}m'), exist_ok=True)
+    return os.path.join(folder, f'{cell_size}m', f'{stem}_{cell_size}m{extension}')
@@ -1,36 +1,166 @@
-import subprocess
-import os
-from db_secrets import EtainDB
+"""
+Loads a GeoTIFF into a PostGIS raster table without raster2pgsql and psql.
+The file is read block by block, every tile is encoded as raster WKB in
+Python and streamed with COPY FROM STDIN over pooled connections, one COPY
+per tile worker. The SRID is read from the file. The spatial index,
+raster constraints and statistics are built once after all tiles are
+loaded, like raster2pgsql -I -C -M.
 
-def raster_to_db(tif_path, table_name, etaindb):
-    creds = etaindb
-    database = creds.db_name
-    user = creds.db_user
-    password = creds.db_pass
-    host = creds.db_address
-    port = creds.db_port
+The raster type has no binary receive function, so tiles are sent as hex
+WKB in a text COPY (as raster2pgsql -Y does) instead of a binary COPY.
+"""
 
+import concurrent.futures
+import struct
 
-    env = os.environ.copy()
-    env["PGPASSWORD"] = password
+import numpy as np
+import rasterio as rio
 
-    raster2pgsql_cmd = [
-        "raster2pgsql", "-s", "4326", "-I", "-C", "-M", "-k", "-t", "1000x1000",  
-        tif_path, table_name
-    ]
-    psql_cmd = [
-        "psql", "-d", database, "-U", user, "-h", host, "-p", str(port)
-    ]
+import db_connection
 
-    raster2pgsql_process = subprocess.Popen(raster2pgsql_cmd, stdout=subprocess.PIPE, env=env)
-    subprocess.run(psql_cmd, stdin=raster2pgsql_process.stdout, env=env)
+TILE_SIZE = 1000
+TILE_WORKERS = 4
+COPY_BUFFER_SIZE = 1024**2
 
-    raster2pgsql_process.stdout.close() 
-    raster2pgsql_process.wait()
+#PostGIS raster pixel types (raster WKB RFC2) and their struct format
+PIXEL_TYPES = {
+    'int8': (3, 'b'),
+    'uint8': (4, 'B'),
+    'int16': (5, 'h'),
+    'uint16': (6, 'H'),
+    'int32': (7, 'i'),
+    'uint32': (8, 'I'),
+    'float32': (10, 'f'),
+    'float64': (11, 'd'),
+}
 
-tif_path = r"C:\scripts\ETAIN_mapping_tools\data\private\test_output_db\output_db_test_CH3.tif"
-table_name = "geoserver.rastertest2"
-etaindb = EtainDB()
 
-raster_to_db(tif_path, table_name, etaindb)
+def raster_wkb(tile, transform, srid, nodata=None):
+    """
+    Encode a tile as PostGIS raster WKB (little endian, format version 0).
 
+    Args:
+        tile (numpy.ndarray): (bands, height, width) pixel values.
+        transform (affine.Affine): Geotransform of the tile.
+        srid (int): SRID of the raster.
+        nodata: Nodata value of all bands, None for none.
+
+    Returns:
+        bytes: The raster WKB.
+    """
+    bands, height, width = tile.shape
+    pixel_type, pixel_format = PIXEL_TYPES[tile.dtype.name]
+    header = struct.pack('<BHHddddddiHH', 1, 0, bands,
+                         transform.a, transform.e, transform.c, transform.f, transform.b, transform.d,
+                         srid, width, height)
+
+    flags = pixel_type | (0x40 if nodata is not None else 0)
+    band_header = struct.pack(f'<B{pixel_format}', flags, nodata if nodata is not None else 0)
+    data = tile.astype(tile.dtype.newbyteorder('<'), copy=False)
+    return header + b''.join(band_header + data[band].tobytes() for band in range(bands))
+
+def tile_windows(height, width, tile_size=TILE_SIZE):
+    """Tile windows row by row, edge tiles are clipped to the raster."""
+    return [rio.windows.Window(col_off, row_off, min(tile_size, width - col_off), min(tile_size, height - row_off))
+            for row_off in range(0, height, tile_size)
+            for col_off in range(0, width, tile_size)]
+
+class _CopyStream:
+    #file-like reader over COPY text lines, for cursor.copy_expert
+    def __init__(self, lines):
+        self._lines = lines
+        self._line = b''
+        self._pos = 0
+
+    def read(self, size=-1):
+        chunks = []
+        wanted = size
+        while size < 0 or wanted > 0:
+            if self._pos == len(self._line):
+                self._line, self._pos = next(self._lines, b''), 0
+                if not self._line:
+                    break
+            end = len(self._line) if size < 0 else min(len(self._line), self._pos + wanted)
+            chunks.append(self._line[self._pos:end])
+            wanted -= end - self._pos
+            self._pos = end
+        return b''.join(chunks)
+
+    readline = read
+
+def _copy_tiles(tif_path, table_name, windows, skip_empty):
+    #load some tiles of the raster with one COPY over a pooled connection
+    loaded = 0
+
+    def lines():
+        nonlocal loaded
+        with rio.open(tif_path) as src:
+            srid = src.crs.to_epsg()
+            for window in windows:
+                tile = src.read(window=window)
+                if skip_empty and src.nodata is not None:
+                    empty = np.isnan(tile).all() if np.isnan(src.nodata) else (tile == src.nodata).all()
+                    if empty:
+                        continue
+                wkb = raster_wkb(tile, src.window_transform(window), srid, src.nodata)
+                loaded += 1
+                yield wkb.hex().encode() + b'\n'
+
+    conn = db_connection.get_engine().raw_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.copy_expert(f'COPY {table_name} (rast) FROM STDIN', _CopyStream(lines()), size=COPY_BUFFER_SIZE)
+        conn.commit()
+    finally:
+        conn.close()
+    return loaded
+
+def raster_to_db(tif_path, table_name, tile_size=TILE_SIZE, workers=TILE_WORKERS, skip_empty=False,
+                 replace=False):
+    """
+    Load a raster into a new PostGIS raster table.
+
+    Args:
+        tif_path (str): Raster to load, its CRS must have an EPSG code.
+        table_name (str): schema.table to create.
+        tile_size (int): Tile width and height in pixels.
+        workers (int): Number of tiles loaded in parallel, each over its
+        own connection.
+        skip_empty (bool): Do not load tiles with only nodata pixels. False
+        keeps them, like raster2pgsql -k.
+        replace (bool): Drop an existing table first.
+    """
+    with rio.open(tif_path) as src:
+        srid = src.crs.to_epsg() if src.crs else None
+        if srid is None:
+            raise ValueError(f'{tif_path} has no EPSG code, cannot derive the SRID')
+        windows = tile_windows(src.height, src.width, tile_size)
+
+    schema, table = table_name.split('.') if '.' in table_name else ('public', table_name)
+    print(f'Loading {len(windows)} tiles of {tif_path} into {table_name} (SRID {srid})...')
+
+    engine = db_connection.get_engine()
+    with engine.begin() as conn:
+        if replace:
+            conn.exec_driver_sql(f'DROP TABLE IF EXISTS {table_name}')
+        conn.exec_driver_sql(f'CREATE TABLE {table_name} (rid serial PRIMARY KEY, rast raster)')
+
+    #every worker loads an interleaved share of the tiles
+    shares = [windows[i::workers] for i in range(workers) if windows[i::workers]]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(shares)) as pool:
+        loaded = sum(pool.map(lambda share: _copy_tiles(tif_path, table_name, share, skip_empty), shares))
+
+    #index, constraints and statistics once, after loading
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.exec_driver_sql(f'CREATE INDEX ON {table_name} USING gist (ST_ConvexHull(rast))')
+        conn.exec_driver_sql(f"SELECT AddRasterConstraints('{schema}', '{table}', 'rast')")
+        conn.exec_driver_sql(f'VACUUM ANALYZE {table_name}')
+    print(f'Loaded {loaded} tiles into {table_name}')
+
+
+if __name__ == '__main__':
+
+    tif_path = r"C:\scripts\ETAIN_mapping_tools\data\private\test_output_db\output_db_test_CH3.tif"
+    table_name = "geoserver.rastertest2"
+
+    raster_to_db(tif_path, table_name)
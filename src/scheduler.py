@@ -0,0 +1,180 @@
+"""
+Runs (country, ssi) jobs over a process pool. Jobs are started largest
+first, using the measurement counts saved by the previous run, and a
+memory budget keeps several large countries from running at the same
+time. A failing job is reported and the other jobs keep running.
+"""
+
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import glob
+import json
+import os
+import traceback
+from datetime import datetime
+
+MEAS_COUNTS_FILE = 'meas_per_country.json'
+
+#rough client side peak memory per fetched measurement row in process_country
+BYTES_PER_ROW = 1000
+#size estimate for jobs without a count from the previous run
+DEFAULT_JOB_ROWS = 1000000
+
+
+def save_meas_counts(run_folder, meas_counts):
+    """
+    Save the measurement counts of this run for the next run's scheduling.
+
+    Args:
+        run_folder (str): Output folder of the run, e.g. .../output/{today}
+        meas_counts (dict): {ssi: {country: measurement count}}
+    """
+    with open(os.path.join(run_folder, MEAS_COUNTS_FILE), 'w') as f:
+        json.dump(meas_counts, f, indent=2, sort_keys=True)
+
+def load_previous_meas_counts(output_root, today):
+    """
+    Load the measurement counts of the most recent earlier run.
+
+    Args:
+        output_root (str): Folder holding one output folder per run date
+        (ddmmyyyy).
+        today (str): Date of the current run (ddmmyyyy), skipped.
+
+    Returns:
+        dict: {ssi: {country: measurement count}}, empty if no earlier
+        run saved its counts.
+    """
+    runs = []
+    for path in glob.glob(os.path.join(output_root, '*', MEAS_COUNTS_FILE)):
+        run_date = os.path.basename(os.path.dirname(path))
+        try:
+            runs.append((datetime.strptime(run_date, '%d%m%Y'), path))
+        except ValueError:
+            continue
+    runs = [run for run in runs if run[0] < datetime.strptime(today, '%d%m%Y')]
+    if not runs:
+        return {}
+
+    with open(max(runs)[1]) as f:
+        return json.load(f)
+
+def _estimate_rows(country, ssi, previous_counts, areas):
+    counts = previous_counts.get(ssi, {})
+    if country in counts:
+        return counts[country]
+    if not areas or country not in areas:
+        return DEFAULT_JOB_ROWS
+    #the measurement density of the countries with counts, times the area of this one
+    known = [c for c in counts if c in areas]
+    known_area = sum(areas[c] for c in known)
+    if not known_area:
+        return DEFAULT_JOB_ROWS
+    return int(sum(counts[c] for c in known) / known_area * areas[country])
+
+def estimate_job_bytes(country, ssi, previous_counts, bytes_per_row=BYTES_PER_ROW, areas=None):
+    """
+    Estimated peak memory of one job from the previous run's counts. ssi
+    may be a tuple for jobs that process several ssi families at once.
+    Countries without a count are estimated from their area, if areas
+    ({country: km²}, see country_borders.country_areas) is given.
+    """
+    ssi_values = ssi if isinstance(ssi, tuple) else (ssi,)
+    rows = sum(_estimate_rows(country, ssi, previous_counts, areas) for ssi in ssi_values)
+    return rows * bytes_per_row
+
+def run_country_jobs(func, jobs, previous_counts, max_workers=None, memory_budget=None,
+                     bytes_per_row=BYTES_PER_ROW, areas=None):
+    """
+    Run func(country, ssi, *args) for every job on a process pool.
+    If ssi is a tuple of ssi families, func returns one result tuple per
+    family, in the same order (e.g. main.process_country_combined).
+
+    Jobs are started largest first. A job is only started while the
+    estimated memory of all running jobs stays within memory_budget, but
+    one job always runs, even if it is larger than the budget on its own.
+    A failing job is recorded and the other jobs keep running. If a worker
+    process dies, the jobs running in the pool are recorded as failed and
+    the pending jobs continue on a new pool.
+
+    Args:
+        func: Top level function returning (country, meas_count, raster_path),
+        e.g. main.process_country.
+        jobs (list): (country, ssi, *args) tuples.
+        previous_counts (dict): {ssi: {country: count}}, see
+        load_previous_meas_counts.
+        max_workers (int): Pool size, os.cpu_count() by default.
+        memory_budget (int): Bytes available to all running jobs, no limit
+        by default.
+        bytes_per_row (int): Estimated peak memory per measurement row.
+        areas (dict): Country areas for jobs without a previous count, see
+        estimate_job_bytes.
+
+    Returns:
+        tuple: (results, failures). results is a list of
+        (ssi, country, meas_count, raster_path), failures a list of
+        (ssi, country, error message).
+    """
+    max_workers = max_workers or os.cpu_count()
+    sizes = {job[:2]: estimate_job_bytes(job[0], job[1], previous_counts, bytes_per_row, areas) for job in jobs}
+    pending = sorted(jobs, key=lambda job: sizes[job[:2]], reverse=True)
+
+    results = []
+    failures = []
+    running = {}
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        while pending or running:
+            #start the largest pending jobs that fit in the remaining budget
+            broken = False
+            running_bytes = sum(sizes[job[:2]] for job in running.values())
+            for job in list(pending):
+                if len(running) >= max_workers:
+                    break
+                fits = memory_budget is None or running_bytes + sizes[job[:2]] <= memory_budget
+                if fits or not running:
+                    try:
+                        future = pool.submit(func, *job)
+                    except BrokenProcessPool:
+                        broken = True
+                        break
+                    pending.remove(job)
+                    running[future] = job
+                    running_bytes += sizes[job[:2]]
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                country, ssi = running.pop(future)[:2]
+                try:
+                    result = future.result()
+                except BrokenProcessPool as e:
+                    #a worker died (e.g. killed out of memory), all running jobs are lost
+                    print(f'{country} {ssi} failed: a worker process died')
+                    failures.append((ssi, country, repr(e)))
+                    broken = True
+                    continue
+                except BaseException as e:
+                    #BaseException: a job calling exit() raises SystemExit
+                    print(f'{country} {ssi} failed:')
+                    traceback.print_exception(type(e), e, e.__traceback__)
+                    failures.append((ssi, country, repr(e)))
+                    continue
+                if isinstance(ssi, tuple):
+                    for ssi_value, (country_code, meas_count, raster_path) in zip(ssi, result):
+                        results.append((ssi_value, country_code, meas_count, raster_path))
+                else:
+                    country_code, meas_count, raster_path = result
+                    results.append((ssi, country_code, meas_count, raster_path))
+
+            if broken:
+                for country, ssi, *_ in running.values():
+                    print(f'{country} {ssi} failed: a worker process died')
+                    failures.append((ssi, country, 'BrokenProcessPool'))
+                running = {}
+                pool.shutdown(wait=False, cancel_futures=True)
+                if pending:
+                    print(f'Restarting the process pool for {len(pending)} pending jobs')
+                pool = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+    finally:
+        pool.shutdown()
+    return results, failures
@@ -1,10 +1,166 @@
-def country_data(country_code,ssi):
+SUBDIVIDED_BORDERS_TABLE = 'spatial_help.european_borders_subdivided'
+EARFCN_FREQUENCY_TABLE = 'spatial_help.earfcn_frequency'
+
+def create_subdivided_borders(max_vertices=256,refresh=False):
+    """
+    Helper table for the indexed country filter: the borders of
+    spatial_help.european_borders_simple transformed once to EPSG:4326 (the
+    SRID of the measurement points) and cut into small pieces with
+    ST_Subdivide, with a GiST index. Created on demand; refresh=True
+    rebuilds it after the borders changed.
+    """
+    drop = f"DROP TABLE IF EXISTS {SUBDIVIDED_BORDERS_TABLE};" if refresh else ''
+    query = f"""
+{drop}
+CREATE TABLE IF NOT EXISTS {SUBDIVIDED_BORDERS_TABLE} AS
+SELECT 
+    eb.nuts,
+    ST_Subdivide(ST_Transform(eb.geom, 4326), {max_vertices}) AS geom
+FROM 
+    spatial_help.european_borders_simple eb;
+
+CREATE INDEX IF NOT EXISTS european_borders_subdivided_geom_idx 
+    ON {SUBDIVIDED_BORDERS_TABLE} USING gist (geom);
+CREATE INDEX IF NOT EXISTS european_borders_subdivided_nuts_idx 
+    ON {SUBDIVIDED_BORDERS_TABLE} (nuts);
+ANALYZE {SUBDIVIDED_BORDERS_TABLE};
+    """
+    return(query)
+
+def create_earfcn_frequency(refresh=False):
+    """
+    Lookup table of country_data_mw: one row per EARFCN of a band with
+    its frequency in MHz. The rows are inserted by
+    helper_functions.ensure_earfcn_frequency from the client side lookup,
+    so the frequencies are the values rounded in Python.
+    """
+    drop = f"DROP TABLE IF EXISTS {EARFCN_FREQUENCY_TABLE};" if refresh else ''
     query = f"""
-WITH geom_points AS (
+{drop}
+CREATE SCHEMA IF NOT EXISTS spatial_help;
+CREATE TABLE IF NOT EXISTS {EARFCN_FREQUENCY_TABLE} (
+    earfcn integer PRIMARY KEY,
+    frequency float8 NOT NULL
+);
+    """
+    return(query)
+
+def earfcn_frequency_exists():
+    """True if the table of create_earfcn_frequency exists and has rows."""
+    query = f"""
+SELECT to_regclass('{EARFCN_FREQUENCY_TABLE}') IS NOT NULL
+   AND EXISTS (SELECT 1 FROM {EARFCN_FREQUENCY_TABLE});
+    """
+    return(query)
+
+def subdivided_borders_exist():
+    """True if the table of create_subdivided_borders exists."""
+    query = f"SELECT to_regclass('{SUBDIVIDED_BORDERS_TABLE}') IS NOT NULL;"
+    return(query)
+
+def _country_filter(country_code,indexed=False):
+    """
+    SQL fragments that keep the geom_points of one country and add their
+    EPSG:3035 x and y.
+
+    indexed=False: every point and the border polygon are transformed to
+    EPSG:3857 inside ST_Within, so no spatial index can be used.
+    indexed=True: points are first prefiltered on the raw lon/lat columns
+    with the country bounding box, then tested with ST_Intersects against
+    the GiST indexed pieces of create_subdivided_borders in their native
+    SRID. Only the surviving points are transformed to EPSG:3035. Points
+    exactly on a border count as inside, and the border edges are straight
+    lines in EPSG:4326 instead of EPSG:3857.
+    """
+    if not indexed:
+        return {
+            'bbox_cte': '',
+            'bbox_join': '',
+            'bbox_where': '',
+            'x': 'ST_X(ST_Transform(gp.geom, 3035))',
+            'y': 'ST_Y(ST_Transform(gp.geom, 3035))',
+            'points_from': f"""geom_points gp
+JOIN 
+    spatial_help.european_borders_simple eb 
+ON 
+    ST_Within(
+        ST_Transform(gp.geom, 3857), 
+        ST_Transform(eb.geom, 3857)
+    )
+WHERE 
+    eb.nuts = '{country_code}'::text""",
+        }
+
+    return {
+        'bbox_cte': f"""country_bbox AS (
     SELECT 
-        md."appId",
-        md.ts,
-        md."DIRECT_connection_mcc_mnc",
+        ST_XMin(ext.geom) AS xmin,
+        ST_YMin(ext.geom) AS ymin,
+        ST_XMax(ext.geom) AS xmax,
+        ST_YMax(ext.geom) AS ymax
+    FROM (
+        SELECT ST_Extent(sb.geom)::geometry AS geom
+        FROM {SUBDIVIDED_BORDERS_TABLE} sb
+        WHERE sb.nuts = '{country_code}'::text
+    ) ext
+),
+
+""",
+        'bbox_join': """
+    CROSS JOIN 
+        country_bbox bb""",
+        'bbox_where': """
+        AND md."LOC_longitude" BETWEEN bb.xmin AND bb.xmax
+        AND md."LOC_latitude" BETWEEN bb.ymin AND bb.ymax""",
+        'x': 'ST_X(gp.geom_3035)',
+        'y': 'ST_Y(gp.geom_3035)',
+        'points_from': f"""(
+    SELECT 
+        gp.*,
+        ST_Transform(gp.geom, 3035) AS geom_3035
+    FROM 
+        geom_points gp
+    WHERE EXISTS (
+        SELECT 1 
+        FROM {SUBDIVIDED_BORDERS_TABLE} sb
+        WHERE sb.nuts = '{country_code}'::text
+            AND ST_Intersects(sb.geom, gp.geom)
+    )
+) gp""",
+    }
+
+def _since_filter(since):
+    # the untyped literal is cast to the type of the ts column
+    if since is None:
+        return ''
+    return f"""
+        AND md.ts > '{since}'"""
+
+#columns only returned when asked for, they are not needed for the rasters
+OPTIONAL_COLUMNS = {'appId': '"appId"', 'ts': 'ts'}
+
+def _optional_columns(alias,optional_columns,indent):
+    for column in optional_columns:
+        if column not in OPTIONAL_COLUMNS:
+            raise ValueError(f'unknown optional column {column}, expected one of {tuple(OPTIONAL_COLUMNS)}')
+    return ''.join(f'{alias}.{OPTIONAL_COLUMNS[column]},\n{indent}' for column in optional_columns)
+
+def country_data(country_code,ssi,indexed=False,since=None,optional_columns=()):
+    """
+    Measurement data of one country. indexed=True uses the index friendly
+    country filter, see _country_filter and create_subdivided_borders.
+    since: only return measurements with a ts after this watermark.
+    optional_columns: any of OPTIONAL_COLUMNS ('appId', 'ts') to return.
+    """
+    cf = _country_filter(country_code,indexed)
+    frequency_joins = '\n'.join(
+        f'        LEFT JOIN {EARFCN_FREQUENCY_TABLE} f{i} ON f{i}.earfcn = cp."LTE_{i}_earfcn"'
+        for i in range(10)
+    )
+    query = f"""
+WITH {cf['bbox_cte']}geom_points AS (
+    SELECT 
+        {_optional_columns('md', optional_columns, '        ')}md."DIRECT_connection_mcc_mnc",
         md."LTE_0_{ssi}",
         md."LTE_1_{ssi}",
         md."LTE_2_{ssi}",
@@ -27,16 +183,14 @@ WITH geom_points AS (
         md."LTE_9_earfcn",
         ST_SetSRID(ST_MakePoint(md."LOC_longitude", md."LOC_latitude"), 4326) AS geom
     FROM 
-        appdata.measurementdata md
+        appdata.measurementdata md{cf['bbox_join']}
     WHERE 
-        md."LTE_0_{ssi}" IS NOT NULL
+        md."LTE_0_{ssi}" IS NOT NULL{cf['bbox_where']}{_since_filter(since)}
 )
 
 SELECT 
-    gp."appId",
-    gp.ts,
-    ST_X(ST_Transform(gp.geom, 3035)) AS x,
-    ST_Y(ST_Transform(gp.geom, 3035)) AS y,
+    {_optional_columns('gp', optional_columns, '    ')}{cf['x']} AS x,
+    {cf['y']} AS y,
     gp."DIRECT_connection_mcc_mnc",
     gp."LTE_0_{ssi}",
     gp."LTE_1_{ssi}",
@@ -59,19 +213,205 @@ SELECT
     gp."LTE_8_earfcn",
     gp."LTE_9_earfcn"
 FROM 
-    geom_points gp
-JOIN 
-    spatial_help.european_borders_simple eb 
-ON 
-    ST_Within(
-        ST_Transform(gp.geom, 3857), 
-        ST_Transform(eb.geom, 3857)
+    {cf['points_from']};
+    """
+    return(query)
+
+def country_data_combined(country_code,ssi_values=('rssi','rsrp'),indexed=False,optional_columns=()):
+    """
+    Variant of country_data that returns the LTE columns of several ssi
+    families (rssi and rsrp) in one scan, so the country filter runs
+    once. A row is returned when LTE_0 of any of the families is set;
+    filter on LTE_0_{ssi} per family to get the rows country_data returns.
+    """
+    cf = _country_filter(country_code,indexed)
+    lte_columns = [f'"LTE_{i}_{ssi}"' for ssi in ssi_values for i in range(10)]
+    lte_columns += [f'"LTE_{i}_earfcn"' for i in range(10)]
+    md_columns = ',\n        '.join(f'md.{column}' for column in lte_columns)
+    gp_columns = ',\n    '.join(f'gp.{column}' for column in lte_columns)
+    ssi_filter = '\n        OR '.join(f'md."LTE_0_{ssi}" IS NOT NULL' for ssi in ssi_values)
+    frequency_joins = '\n'.join(
+        f'        LEFT JOIN {EARFCN_FREQUENCY_TABLE} f{i} ON f{i}.earfcn = cp."LTE_{i}_earfcn"'
+        for i in range(10)
+    )
+    query = f"""
+WITH {cf['bbox_cte']}geom_points AS (
+    SELECT 
+        {_optional_columns('md', optional_columns, '        ')}md."DIRECT_connection_mcc_mnc",
+        {md_columns},
+        ST_SetSRID(ST_MakePoint(md."LOC_longitude", md."LOC_latitude"), 4326) AS geom
+    FROM 
+        appdata.measurementdata md{cf['bbox_join']}
+    WHERE 
+        ({ssi_filter}){cf['bbox_where']}
+)
+
+SELECT 
+    {_optional_columns('gp', optional_columns, '    ')}{cf['x']} AS x,
+    {cf['y']} AS y,
+    gp."DIRECT_connection_mcc_mnc",
+    {gp_columns}
+FROM 
+    {cf['points_from']};
+    """
+    return(query)
+
+def _frequency_expression(i):
+    # NULL for EARFCNs outside the bands, like the NaN of the client side lookup
+    return f'f{i}.frequency'
+
+def country_data_mw(country_code,ssi,indexed=False):
+    """
+    Server side variant of country_data that returns one summed mW value
+    per measurement instead of the raw LTE columns.
+
+    Mirrors add_frequency_colums, normalize_ssi and convert_dBm_to_mW:
+    every LTE_i_{ssi} value is normalized to 1800 MHz using the frequency
+    of its EARFCN, converted to mW and summed. Rows with a zero total or
+    a missing/'x'/'y' network provider are dropped.
+
+    The frequencies are joined from the table of create_earfcn_frequency,
+    which holds the rounded values of the client side lookup.
+    indexed: use the index friendly country filter, see _country_filter
+    """
+    cf = _country_filter(country_code,indexed)
+    mw_columns = ' +\n'.join(
+        f"""        COALESCE(power(10::float8, round((cp."LTE_{i}_{ssi}" + 20 * log(
+            {_frequency_expression(i)} / 1800
+        ))::numeric, 2)::float8 / 10), 0)"""
+        for i in range(10)
     )
+    frequency_joins = '\n'.join(
+        f'        LEFT JOIN {EARFCN_FREQUENCY_TABLE} f{i} ON f{i}.earfcn = cp."LTE_{i}_earfcn"'
+        for i in range(10)
+    )
+    query = f"""
+WITH {cf['bbox_cte']}geom_points AS (
+    SELECT 
+        md."DIRECT_connection_mcc_mnc",
+        md."LTE_0_{ssi}",
+        md."LTE_1_{ssi}",
+        md."LTE_2_{ssi}",
+        md."LTE_3_{ssi}",
+        md."LTE_4_{ssi}",
+        md."LTE_5_{ssi}",
+        md."LTE_6_{ssi}",
+        md."LTE_7_{ssi}",
+        md."LTE_8_{ssi}",
+        md."LTE_9_{ssi}",
+        md."LTE_0_earfcn",
+        md."LTE_1_earfcn",
+        md."LTE_2_earfcn",
+        md."LTE_3_earfcn",
+        md."LTE_4_earfcn",
+        md."LTE_5_earfcn",
+        md."LTE_6_earfcn",
+        md."LTE_7_earfcn",
+        md."LTE_8_earfcn",
+        md."LTE_9_earfcn",
+        ST_SetSRID(ST_MakePoint(md."LOC_longitude", md."LOC_latitude"), 4326) AS geom
+    FROM 
+        appdata.measurementdata md{cf['bbox_join']}
+    WHERE 
+        md."LTE_0_{ssi}" IS NOT NULL
+        AND md."DIRECT_connection_mcc_mnc" IS NOT NULL
+        AND md."DIRECT_connection_mcc_mnc"::text NOT IN ('x', 'y'){cf['bbox_where']}
+),
+
+country_points AS (
+    SELECT 
+        {cf['x']} AS x,
+        {cf['y']} AS y,
+        gp.*
+    FROM 
+        {cf['points_from']}
+),
+
+mw_points AS (
+    SELECT 
+        cp.x,
+        cp.y,
+        cp."DIRECT_connection_mcc_mnc",
+{mw_columns} AS "LTE_mW_total"
+    FROM 
+        country_points cp
+{frequency_joins}
+)
+
+SELECT 
+    x,
+    y,
+    "DIRECT_connection_mcc_mnc",
+    "LTE_mW_total"
+FROM 
+    mw_points
 WHERE 
-    eb.nuts = '{country_code}'::text;
+    "LTE_mW_total" <> 0;
     """
     return(query)
 
+def hexgrid_counts(country_code):
+    """
+    Number of LTE measurements per cell of the 500 m hexgrid of a country,
+    counted in PostGIS (server engine of generate_count_grid). Measurements
+    are prefiltered on the raw lon/lat columns with the grid extent in
+    EPSG:4326, and each remaining point finds its cell through the GiST
+    index of the grid. Cells without measurements get point_count 0.
+    ST_Contains does not count points on a cell border, the client engine
+    counts them in one neighbouring cell.
+    """
+    grid = f'hexagon_grids."{country_code}_hexgrid_500m"'
+    query = f"""
+WITH grid_srid AS (
+    SELECT ST_SRID(geom) AS srid FROM {grid} LIMIT 1
+),
+grid_extent AS (
+    --densified before the transform, so the curved edges stay inside the box
+    SELECT ST_Transform(ST_Segmentize(ST_SetSRID(ST_Extent(g.geom)::geometry, s.srid),
+                                      (ST_XMax(ST_Extent(g.geom)) - ST_XMin(ST_Extent(g.geom))) / 100), 4326) AS geom,
+           s.srid
+    FROM {grid} g, grid_srid s
+    GROUP BY s.srid
+),
+points AS (
+    SELECT ST_Transform(ST_SetSRID(ST_MakePoint(m."LOC_longitude", m."LOC_latitude"), 4326), e.srid) AS geom
+    FROM appdata.measurementdata m, grid_extent e
+    WHERE m."LOC_longitude" IS NOT NULL AND (m."LTE_0_rssi" IS NOT NULL OR m."LTE_0_rsrp" IS NOT NULL)
+      AND m."LOC_longitude" BETWEEN ST_XMin(e.geom) AND ST_XMax(e.geom)
+      AND m."LOC_latitude" BETWEEN ST_YMin(e.geom) AND ST_YMax(e.geom)
+),
+counts AS (
+    SELECT g.fid, COUNT(*) AS point_count
+    FROM points p
+    JOIN {grid} g ON ST_Contains(g.geom, p.geom)
+    GROUP BY g.fid
+)
+SELECT g.fid, COALESCE(c.point_count, 0)::integer AS point_count, g.geom
+FROM {grid} g
+LEFT JOIN counts c ON c.fid = g.fid
+ORDER BY g.fid
+    """
+    return(query)
+
+def create_ts_index():
+    """
+    Index on the measurement ts, so data_watermark is an index lookup
+    instead of a full scan of appdata.measurementdata.
+    """
+    query = '''
+    CREATE INDEX IF NOT EXISTS measurementdata_ts_idx
+    ON appdata.measurementdata (ts)
+    '''
+    return query
+
+def data_watermark():
+    #latest measurement ts, needs the index of create_ts_index on large tables
+    query = '''
+    SELECT MAX(ts) AS watermark
+    FROM appdata.measurementdata
+    '''
+    return query
+
 def fetch_metadata():
     query = '''
     SELECT 
@@ -80,3 +420,22 @@ def fetch_metadata():
     FROM appdata.measurementdata
     '''
     return query
+
+def borders_fingerprint():
+    """Hash of all border geometries, changes whenever a border is edited."""
+    query = '''
+    SELECT md5(string_agg(eb.nuts || ':' || md5(ST_AsEWKB(eb.geom)), ',' ORDER BY eb.nuts, ST_AsEWKB(eb.geom))) AS fingerprint
+    FROM spatial_help.european_borders_simple eb
+    '''
+    return query
+
+def borders_3035(tolerance):
+    """Border polygons per nuts code in EPSG:3035, simplified to tolerance meters."""
+    query = f'''
+    SELECT 
+        eb.nuts,
+        ST_SimplifyPreserveTopology(ST_Transform(eb.geom, 3035), {tolerance}) AS geom
+    FROM spatial_help.european_borders_simple eb
+    ORDER BY eb.nuts
+    '''
+    return query
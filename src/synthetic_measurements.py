@@ -0,0 +1,169 @@
+"""
+Synthetic appdata.measurementdata rows for benchmarks and tests without
+the production database. Measurements are clustered around a number of
+hot spots (cities, roads) over a uniform background, use the EARFCNs of
+the bands common in Europe from the band table, several network
+providers plus the junk providers the pipeline filters out, and a
+decreasing number of neighbour cells, so LTE_1..9 get sparser.
+"""
+
+import io
+
+import numpy as np
+import pandas as pd
+from pyproj import Transformer
+
+import db_connection
+import helper_functions as hf
+
+#Luxembourg
+DEFAULT_BOUNDS = (5.73, 49.45, 6.53, 50.18)
+DEFAULT_PROVIDERS = {'27001': 0.4, '27077': 0.3, '27099': 0.2, '27005': 0.06, 'x': 0.02, 'y': 0.01, None: 0.01}
+#share of the measurements per LTE band
+DEFAULT_BAND_MIX = {3: 0.35, 20: 0.2, 7: 0.2, 1: 0.1, 8: 0.1, 28: 0.05}
+
+
+def _band_earfcns(band_mix, mapping_path=hf.EARFCN_MAPPING_PATH):
+    bands = pd.read_csv(mapping_path, delimiter=';').set_index('Band')
+    ranges = [(int(bands.loc[band, 'earfcn_low']), int(bands.loc[band, 'earfcn_high'])) for band in band_mix]
+    weights = np.array(list(band_mix.values()), dtype=np.float64)
+    return ranges, weights / weights.sum()
+
+def _random_earfcns(rng, n, band_ranges, band_weights):
+    band = rng.choice(len(band_ranges), n, p=band_weights)
+    low = np.array([r[0] for r in band_ranges])[band]
+    high = np.array([r[1] for r in band_ranges])[band]
+    return rng.integers(low, high + 1)
+
+def _clustered_coordinates(rng, n, bounds, n_clusters, background):
+    lon_min, lat_min, lon_max, lat_max = bounds
+    centers = np.column_stack([rng.uniform(lon_min, lon_max, n_clusters), rng.uniform(lat_min, lat_max, n_clusters)])
+    #a few large clusters and many small ones
+    weights = 1 / np.arange(1, n_clusters + 1)
+    spread = rng.lognormal(np.log(0.01), 0.7, n_clusters)
+
+    cluster = rng.choice(n_clusters, n, p=weights / weights.sum())
+    lon = centers[cluster, 0] + rng.normal(0, 1, n) * spread[cluster]
+    lat = centers[cluster, 1] + rng.normal(0, 1, n) * spread[cluster]
+    uniform = rng.random(n) < background
+    lon[uniform] = rng.uniform(lon_min, lon_max, uniform.sum())
+    lat[uniform] = rng.uniform(lat_min, lat_max, uniform.sum())
+    return np.clip(lon, lon_min, lon_max), np.clip(lat, lat_min, lat_max)
+
+def generate_measurements(n_rows, seed=0, bounds=DEFAULT_BOUNDS, n_clusters=25, background=0.1,
+                          providers=DEFAULT_PROVIDERS, band_mix=DEFAULT_BAND_MIX, include_ids=True):
+    """
+    Generate synthetic measurement rows with the columns of
+    appdata.measurementdata used by the pipeline.
+
+    Args:
+        n_rows (int): Number of rows.
+        seed (int): Random seed, the same seed gives the same rows.
+        bounds (tuple): (lon_min, lat_min, lon_max, lat_max) in EPSG:4326.
+        n_clusters (int): Number of measurement hot spots.
+        background (float): Share of uniformly distributed measurements.
+        providers (dict): {mcc_mnc: share}, None for a missing provider.
+        band_mix (dict): {LTE band: share} of the EARFCNs.
+        include_ids (bool): Add appId and ts.
+
+    Returns:
+        pandas.DataFrame: LOC_longitude, LOC_latitude,
+        DIRECT_connection_mcc_mnc and LTE_0..9 rssi, rsrp and earfcn in
+        the dtypes of hf.measurement_dtypes, and optionally appId and ts.
+    """
+    rng = np.random.default_rng(seed)
+    lon, lat = _clustered_coordinates(rng, n_rows, bounds, n_clusters, background)
+    df = pd.DataFrame({'LOC_longitude': lon, 'LOC_latitude': lat})
+    if include_ids:
+        df['appId'] = pd.Series(rng.integers(0, max(n_rows // 500, 1), n_rows)).map('app{:06d}'.format)
+        df['ts'] = pd.Timestamp('2025-01-01', tz='UTC') + pd.to_timedelta(rng.integers(0, 365 * 86400, n_rows), unit='s')
+
+    #missing providers (None) become NaN
+    names = list(providers)
+    shares = np.array(list(providers.values()), dtype=np.float64)
+    categories = [name for name in names if name is not None]
+    name_codes = np.array([categories.index(name) if name is not None else -1 for name in names])
+    codes = name_codes[rng.choice(len(names), n_rows, p=shares / shares.sum())]
+    df['DIRECT_connection_mcc_mnc'] = pd.Categorical.from_codes(codes, categories=categories)
+
+    #serving cell plus a geometric number of neighbours, LTE_i is set for i < cells
+    cells = np.minimum(rng.geometric(0.35, n_rows), 10)
+    rsrp_0 = np.clip(rng.normal(-95, 12, n_rows), -140, -44)
+    rssi_0 = np.clip(rsrp_0 + rng.normal(27, 4, n_rows), -120, -25)
+    band_ranges, band_weights = _band_earfcns(band_mix)
+    rssi_missing = rng.random(n_rows) < 0.15
+    for i in range(10):
+        present = cells > i
+        weaker = np.abs(rng.normal(6 * i, 3, n_rows))
+        rsrp = np.where(present, np.round(rsrp_0 - weaker), np.nan)
+        rssi = np.where(present & ~rssi_missing, np.round(rssi_0 - weaker), np.nan)
+        earfcn = pd.array(np.where(present, _random_earfcns(rng, n_rows, band_ranges, band_weights), 0),
+                          dtype=hf.EARFCN_DTYPE)
+        earfcn[~present] = pd.NA
+        df[f'LTE_{i}_rssi'] = rssi.astype(hf.VALUE_DTYPE)
+        df[f'LTE_{i}_rsrp'] = rsrp.astype(hf.VALUE_DTYPE)
+        df[f'LTE_{i}_earfcn'] = earfcn
+    return df
+
+def to_country_frame(measurements, ssi):
+    """
+    The frame fetch_country_data would return for the synthetic rows:
+    rows with LTE_0_{ssi} set, EPSG:3035 x and y, in the dtypes of
+    hf.measurement_dtypes. All rows count as inside the country.
+    """
+    rows = measurements[measurements[f'LTE_0_{ssi}'].notna()]
+    transformer = Transformer.from_crs('EPSG:4326', 'EPSG:3035', always_xy=True)
+    x, y = transformer.transform(rows['LOC_longitude'].to_numpy(), rows['LOC_latitude'].to_numpy())
+    columns = (['DIRECT_connection_mcc_mnc'] + [f'LTE_{i}_{ssi}' for i in range(10)]
+               + [f'LTE_{i}_earfcn' for i in range(10)])
+    df = rows[columns].reset_index(drop=True)
+    df.insert(0, 'x', x)
+    df.insert(1, 'y', y)
+    return df.astype(hf.measurement_dtypes((ssi,)))
+
+def load_into_postgis(measurements, country_code, engine=None):
+    """
+    Create appdata.measurementdata with the synthetic rows and a border
+    polygon for country_code (the bounding box of the rows) in
+    spatial_help.european_borders_simple, for running the database
+    pipeline against a throwaway local PostGIS. The rows are loaded with
+    COPY. Refuses to touch a database that already has measurements.
+    """
+    engine = engine or db_connection.get_engine()
+    with engine.begin() as conn:
+        if conn.exec_driver_sql("SELECT to_regclass('appdata.measurementdata')").scalar():
+            raise RuntimeError('appdata.measurementdata already exists, use a throwaway database')
+        conn.exec_driver_sql('CREATE EXTENSION IF NOT EXISTS postgis')
+        conn.exec_driver_sql('CREATE SCHEMA IF NOT EXISTS appdata')
+        conn.exec_driver_sql('CREATE SCHEMA IF NOT EXISTS spatial_help')
+        conn.exec_driver_sql('CREATE TABLE IF NOT EXISTS spatial_help.european_borders_simple '
+                             '(nuts text, geom geometry(MultiPolygon, 3035))')
+        conn.exec_driver_sql(f"""
+            INSERT INTO spatial_help.european_borders_simple
+            SELECT '{country_code}', ST_Multi(ST_Transform(ST_MakeEnvelope(
+                {measurements['LOC_longitude'].min()}, {measurements['LOC_latitude'].min()},
+                {measurements['LOC_longitude'].max()}, {measurements['LOC_latitude'].max()}, 4326), 3035))
+        """)
+        #empty table with the column types, the rows follow with COPY
+        measurements.head(0).to_sql('measurementdata', conn, schema='appdata', index=False)
+
+    columns = ', '.join(f'"{column}"' for column in measurements.columns)
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cur:
+            buffer = io.StringIO()
+            measurements.to_csv(buffer, index=False, header=False)
+            buffer.seek(0)
+            cur.copy_expert(f'COPY appdata.measurementdata ({columns}) FROM STDIN WITH (FORMAT csv)', buffer)
+        conn.commit()
+    finally:
+        conn.close()
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.exec_driver_sql('ANALYZE appdata.measurementdata')
+
+def drop_from_postgis(country_code, engine=None):
+    """Drop the tables and rows created by load_into_postgis."""
+    engine = engine or db_connection.get_engine()
+    with engine.begin() as conn:
+        conn.exec_driver_sql('DROP TABLE IF EXISTS appdata.measurementdata')
+        conn.exec_driver_sql(f"DELETE FROM spatial_help.european_borders_simple WHERE nuts = '{country_code}'")
@@ -0,0 +1,131 @@
+"""
+Tiled execution of the binning and calibration of one country, so a
+large country is spread over all cores instead of one. The country grid
+(see binning.grid_edges) is cut into square tiles of TILE_CELLS cells,
+aligned to the COG blocks of save_raster, and every tile is binned and
+calibrated on its own in a process pool.
+
+Measurements are assigned to their cell on the country grid before they
+are split, and providers keep their country wide codes, so every cell
+gets the same medians, in the same summation order, as the whole-country
+binning. The tiles are merged into one binning.SparseGrid, which
+save_raster writes as one COG, so there are no seams.
+"""
+
+import concurrent.futures
+
+import numpy as np
+import rasterio as rio
+
+import binning
+import external_median
+import helper_functions as hf
+
+#tile width and height in cells, a multiple of the raster block size
+TILE_CELLS = 4 * hf.RASTER_TILE_SIZE
+
+
+def partition_tiles(df, x_edges, y_edges, tile_cells=TILE_CELLS):
+    """
+    Split the measurements into the tiles of the grid.
+
+    Args:
+        df (DataFrame): Measurements with 'x', 'y',
+        'DIRECT_connection_mcc_mnc' and 'LTE_mW_total' columns.
+        x_edges, y_edges (numpy.ndarray): Grid edges from grid_edges.
+        tile_cells (int): Tile width and height in cells.
+
+    Returns:
+        list: (row_off, col_off, provider_ids, rows, cols, values) per tile
+        with measurements, in raster orientation (row 0 is the northern
+        edge). rows and cols are relative to the tile.
+    """
+    ncols, nrows = len(x_edges) - 1, len(y_edges) - 1
+
+    #providers are coded in order of first appearance over the whole country
+    provider_ids, xi, yi, values = binning.cell_indices(df, x_edges, y_edges)
+    rows = nrows - 1 - yi
+    cols = xi
+
+    tiles_per_row = -(-ncols // tile_cells)
+    tile_ids = (rows // tile_cells) * tiles_per_row + cols // tile_cells
+    order = np.argsort(tile_ids, kind='stable')
+    tile_ids = tile_ids[order]
+    starts = np.flatnonzero(np.diff(tile_ids, prepend=-1))
+    ends = np.append(starts[1:], len(tile_ids))
+
+    tiles = []
+    for start, end in zip(starts, ends):
+        row_off = int(tile_ids[start] // tiles_per_row) * tile_cells
+        col_off = int(tile_ids[start] % tiles_per_row) * tile_cells
+        points = order[start:end]
+        tiles.append((row_off, col_off, provider_ids[points], rows[points] - row_off,
+                      cols[points] - col_off, values[points]))
+    return tiles
+
+def bin_tile(provider_ids, rows, cols, values, calibration_method, tile_cells=TILE_CELLS):
+    """
+    Bin and calibrate one tile, like create_exposure_array and
+    map_calibration do for a whole country.
+
+    Returns:
+        tuple: (rows, cols, calibrated, counts) of the cells with data,
+        relative to the tile.
+    """
+    unique_cells, sums, counts = binning.grouped_cell_sums(provider_ids, rows * tile_cells + cols, values)
+    calibrated = hf.map_calibration(10 * np.log10(sums), calibration_method)
+    return unique_cells // tile_cells, unique_cells % tile_cells, calibrated, counts
+
+def calibrated_grid(df, cell_size, calibration_method, tile_cells=TILE_CELLS, max_workers=None, bounds=None):
+    """
+    Tiled create_exposure_array(sparse=True) followed by map_calibration.
+
+    Args:
+        df (DataFrame): Output of convert_dBm_to_mW. An
+        external_median.SpilledMeasurements is binned out of core in this
+        process instead.
+        cell_size: Cell size in CRS units (meters in EPSG:3035).
+        calibration_method (str): 'LTE_rssi' or 'LTE_rsrp'.
+        tile_cells (int): Tile width and height in cells.
+        max_workers (int): Pool size, os.cpu_count() by default.
+        bounds (tuple): Grid bounds instead of the data bounds, see
+        create_exposure_array.
+
+    Returns:
+        tuple: (calibrated, counts, transform), calibrated and counts as
+        binning.SparseGrid.
+    """
+    if isinstance(df, external_median.SpilledMeasurements):
+        exposure_grid, count_grid, transform = hf.create_exposure_array(df, None, cell_size, sparse=True,
+                                                                        bounds=bounds)
+        return hf.map_calibration(exposure_grid, calibration_method), count_grid, transform
+
+    xmin, ymin, xmax, ymax = bounds if bounds is not None else (df['x'].min(), df['y'].min(),
+                                                                df['x'].max(), df['y'].max())
+    x_edges, y_edges = binning.grid_edges(xmin, xmax, ymin, ymax, cell_size)
+    transform = rio.transform.from_origin(x_edges[0], y_edges[-1], cell_size, cell_size)
+    ncols, nrows = len(x_edges) - 1, len(y_edges) - 1
+
+    tiles = partition_tiles(df, x_edges, y_edges, tile_cells)
+    print(f'Binning {len(tiles)} tiles of {tile_cells}x{tile_cells} cells...')
+    offsets = [(row_off, col_off) for row_off, col_off, *_ in tiles]
+    jobs = [(*tile[2:], calibration_method, tile_cells) for tile in tiles]
+    del tiles
+    if len(jobs) <= 1 or max_workers == 1:
+        results = [bin_tile(*job) for job in jobs]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(bin_tile, *job) for job in jobs]
+            del jobs
+            results = [future.result() for future in futures]
+
+    if not results:
+        empty = np.empty(0, dtype=np.int64)
+        return (binning.SparseGrid(nrows, ncols, empty, empty, np.empty(0)),
+                binning.SparseGrid(nrows, ncols, empty, empty, np.empty(0)), transform)
+    rows = np.concatenate([tile_rows + row_off for (row_off, _), (tile_rows, *_) in zip(offsets, results)])
+    cols = np.concatenate([tile_cols + col_off for (_, col_off), (_, tile_cols, *_) in zip(offsets, results)])
+    calibrated = np.concatenate([result[2] for result in results])
+    counts = np.concatenate([result[3] for result in results])
+    return (binning.SparseGrid(nrows, ncols, rows, cols, calibrated),
+            binning.SparseGrid(nrows, ncols, rows, cols, counts), transform)